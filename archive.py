@@ -0,0 +1,167 @@
+import array
+import bisect
+import collections
+import json
+import os
+import threading
+import zlib
+
+# Rows per compressed block; reads decompress whole blocks
+BLOCK_MESSAGES = 256
+BLOCK_CACHE_SIZE = 64
+
+ARCHIVE_SUFFIX = ".arc"
+INDEX_SUFFIX = ".idx"
+# Holds the id of the database whose messages the directory archives
+OWNER_FILE = "owner"
+
+
+class ArchiveFile:
+    """A read-only file of zlib-compressed message blocks.
+
+    The sidecar index holds (first id, last id, offset, length) for every
+    block, so a read only decompresses the blocks that overlap its range.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        name = os.path.basename(path)[: -len(ARCHIVE_SUFFIX)]
+        first_id, last_id = name.split("-")
+        self.first_id = int(first_id)
+        self.last_id = int(last_id)
+        self.index = array.array("q")
+        with open(path[: -len(ARCHIVE_SUFFIX)] + INDEX_SUFFIX, "rb") as f:
+            self.index.frombytes(f.read())
+        # Last id of each block, for bisecting
+        self.block_last_ids = self.index[1::4]
+
+    def block_count(self):
+        return len(self.index) // 4
+
+    def first_block_after(self, last_id):
+        return bisect.bisect_right(self.block_last_ids, last_id)
+
+    def block_location(self, block):
+        return self.index[block * 4 + 2], self.index[block * 4 + 3]
+
+
+class MessageArchive:
+    """Compressed, read-only history for messages moved out of the live table."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.files = []
+        self.block_cache = collections.OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        names = set(os.listdir(directory))
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if name.endswith(ARCHIVE_SUFFIX):
+                self.files.append(ArchiveFile(path))
+            elif name.endswith(".tmp") or (
+                # Left by a write that was never published
+                name.endswith(INDEX_SUFFIX)
+                and name[: -len(INDEX_SUFFIX)] + ARCHIVE_SUFFIX not in names
+            ):
+                os.remove(path)
+        self.owner = None
+        owner_path = os.path.join(directory, OWNER_FILE)
+        if os.path.exists(owner_path):
+            with open(owner_path) as f:
+                self.owner = f.read().strip()
+
+    def set_owner(self, owner):
+        """Record which database this archive belongs to."""
+        owner_path = os.path.join(self.directory, OWNER_FILE)
+        with open(owner_path + ".tmp", "w") as f:
+            f.write(owner + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(owner_path + ".tmp", owner_path)
+        self.owner = owner
+
+    @property
+    def max_id(self):
+        with self.lock:
+            return self.files[-1].last_id if self.files else 0
+
+    def write(self, rows):
+        """Archive (id, username, message) rows, ordered by id, as a new file.
+
+        The file keeps a temporary name, so neither reads nor a restart see
+        it, until the returned path is passed to publish().
+        """
+        if not rows:
+            return None
+        first_id, last_id = rows[0][0], rows[-1][0]
+        base = os.path.join(self.directory, f"{first_id:020d}-{last_id:020d}")
+        index = array.array("q")
+        offset = 0
+        with open(base + ARCHIVE_SUFFIX + ".tmp", "wb") as f:
+            for start in range(0, len(rows), BLOCK_MESSAGES):
+                block = rows[start : start + BLOCK_MESSAGES]
+                data = zlib.compress(
+                    json.dumps([list(row) for row in block]).encode("utf-8")
+                )
+                f.write(data)
+                index.extend((block[0][0], block[-1][0], offset, len(data)))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(base + INDEX_SUFFIX, "wb") as f:
+            f.write(index.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return base
+
+    def publish(self, base):
+        """Give a file from write() its final name and make it visible to reads."""
+        with self.lock:
+            os.replace(base + ARCHIVE_SUFFIX + ".tmp", base + ARCHIVE_SUFFIX)
+            self.files.append(ArchiveFile(base + ARCHIVE_SUFFIX))
+
+    def discard(self, base):
+        """Delete an unpublished file returned by write()."""
+        os.remove(base + ARCHIVE_SUFFIX + ".tmp")
+        os.remove(base + INDEX_SUFFIX)
+
+    def read_block(self, archive_file, block):
+        key = (archive_file.path, block)
+        with self.lock:
+            rows = self.block_cache.get(key)
+            if rows is not None:
+                self.block_cache.move_to_end(key)
+                return rows
+        offset, length = archive_file.block_location(block)
+        with open(archive_file.path, "rb") as f:
+            f.seek(offset)
+            rows = json.loads(zlib.decompress(f.read(length)))
+        with self.lock:
+            self.block_cache[key] = rows
+            if len(self.block_cache) > BLOCK_CACHE_SIZE:
+                self.block_cache.popitem(last=False)
+        return rows
+
+    def read_since(self, last_id, limit=None, max_id=None):
+        """Return archived messages with ids in (last_id, max_id], oldest first."""
+        with self.lock:
+            files = [f for f in self.files if f.last_id > last_id]
+        messages = []
+        for archive_file in files:
+            for block in range(
+                archive_file.first_block_after(last_id), archive_file.block_count()
+            ):
+                for message_id, username, message in self.read_block(
+                    archive_file, block
+                ):
+                    if message_id <= last_id:
+                        continue
+                    if max_id is not None and message_id > max_id:
+                        return messages
+                    messages.append(
+                        {"id": message_id, "username": username, "message": message}
+                    )
+                    if limit is not None and len(messages) >= limit:
+                        return messages
+        return messages
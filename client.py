@@ -1,10 +1,88 @@
+import codecs
+import json
 import os
+import random
+import re
 import select
 import socket
 import sys
 import termios
+import time
 import tty
 
+# Last seen message id per server, so a restarted client only replays what it missed
+STATE_FILE = os.environ.get(
+    "CHAT_CLIENT_STATE_FILE", os.path.expanduser("~/.chat_client_state")
+)
+STATE_SAVE_INTERVAL = 5
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RESUME_COMMAND = "__Resume__"
+USERNAME_PROMPT = "Enter your username:"
+# The server puts "@<id> " in front of messages, or sends a bare "@<id>" line
+# to acknowledge one of ours
+MESSAGE_ID_PATTERN = re.compile(r"^@(\d+)(?: |\n)", re.MULTILINE)
+RECV_SIZE = 65536
+INPUT_READ_SIZE = 1024
+
+
+def prompt_length(username, input_buffer):
+    if username is None:
+        return len(input_buffer)
+    return len(f"{username}: ") + len(input_buffer)
+
+
+def load_last_id(server_key):
+    try:
+        with open(STATE_FILE) as f:
+            return int(json.load(f).get(server_key, 0))
+    except (OSError, ValueError, TypeError, AttributeError):
+        return 0
+
+
+def save_last_id(server_key, last_id):
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+        if not isinstance(state, dict):
+            state = {}
+    except (OSError, ValueError):
+        state = {}
+    state[server_key] = last_id
+    try:
+        with open(STATE_FILE + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(STATE_FILE + ".tmp", STATE_FILE)
+    except OSError as e:
+        print(f"\nCould not save client state to {STATE_FILE}: {e}")
+
+
+def connect_to_server(host, port, last_id, username):
+    clientsocket = socket.create_connection((host, port))
+    # Ask for the messages after last_id, or the recent tail when we have none
+    handshake = f"{RESUME_COMMAND} {last_id}\n" if last_id else f"{RESUME_COMMAND}\n"
+    if username is not None:
+        handshake += username + "\n"
+    clientsocket.sendall(handshake.encode("utf-8"))
+    clientsocket.setblocking(False)
+    return clientsocket
+
+
+def reconnect(host, port, last_id, username):
+    # Exponential backoff with full jitter so clients do not all return at once
+    delay = RECONNECT_BASE_DELAY
+    print("\nConnection lost.")
+    while True:
+        wait = random.uniform(0, delay)
+        print(f"Reconnecting in {wait:.1f}s...")
+        time.sleep(wait)
+        try:
+            clientsocket = connect_to_server(host, port, last_id, username)
+            print("Reconnected.")
+            return clientsocket
+        except OSError:
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
 
 def init_client():
     # Default hostname and port
@@ -26,17 +104,23 @@ def init_client():
     else:
         port = default_port
 
-    clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_key = f"{host}:{port}"
+    last_id = load_last_id(server_key)
+    saved_id = last_id
+    saved_at = time.monotonic()
     try:
-        clientsocket.connect((host, port))
-    except ConnectionRefusedError:
+        clientsocket = connect_to_server(host, port, last_id, None)
+    except OSError:
         print(f"Could not connect to server {host}:{port}")
         return
-    clientsocket.setblocking(False)
 
     username = None
     input_buffer = ""
     recv_buffer = b""
+    # The prompt line is only redrawn once a burst of incoming data is drained
+    prompt_visible = False
+    skip_username_prompt = False
+    input_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
 
     # Save the terminal settings
     original_settings = termios.tcgetattr(sys.stdin)
@@ -45,72 +129,99 @@ def init_client():
         # Set terminal to cbreak mode
         tty.setcbreak(sys.stdin.fileno())
 
-        inputs = [clientsocket, sys.stdin]
-
         while True:
-            readable, _, _ = select.select(inputs, [], [])
+            readable, _, _ = select.select([clientsocket, sys.stdin], [], [])
 
             for s in readable:
                 if s == clientsocket:
-                    data = clientsocket.recv(4096)
+                    try:
+                        data = clientsocket.recv(RECV_SIZE)
+                    except OSError:
+                        data = b""
                     if data:
                         recv_buffer += data
-                        while b"\n" in recv_buffer:
-                            line, recv_buffer = recv_buffer.split(b"\n", 1)
-                            message = line.decode("utf-8")
-                            # Clear current line
-                            sys.stdout.write("\r")
+                        # Render every complete line from this wake-up in one write
+                        end = recv_buffer.rfind(b"\n") + 1
+                        block = recv_buffer[:end].decode("utf-8", errors="replace")
+                        recv_buffer = recv_buffer[end:]
+                        message_ids = MESSAGE_ID_PATTERN.findall(block)
+                        if message_ids:
+                            last_id = max(last_id, int(message_ids[-1]))
+                            block = MESSAGE_ID_PATTERN.sub("", block)
+                        if skip_username_prompt and block:
+                            # Already answered as part of the reconnect handshake
+                            skip_username_prompt = False
+                            if block.startswith(USERNAME_PROMPT + "\n"):
+                                block = block[len(USERNAME_PROMPT) + 1 :]
+                        # While more data is already queued (e.g. a history replay),
+                        # write the lines straight out and leave the prompt for later
+                        burst = bool(select.select([clientsocket], [], [], 0)[0])
+                        output = []
+                        if block and prompt_visible:
+                            padding = " " * (prompt_length(username, input_buffer) + 10)
+                            output.append(f"\r{padding}\r")
+                            prompt_visible = False
+                        output.append(block)
+                        if not burst and not prompt_visible and username is not None:
+                            output.append(f"{username}: {input_buffer}")
+                            prompt_visible = True
+                        if output != [""]:
+                            sys.stdout.write("".join(output))
                             sys.stdout.flush()
-                            # Determine the prompt length
-                            if username is None:
-                                prompt_length = len(input_buffer)
-                            else:
-                                prompt_length = len(f"{username}: ") + len(input_buffer)
-                            # Clear the line
-                            sys.stdout.write(" " * (prompt_length + 10))
-                            sys.stdout.write("\r")
-                            sys.stdout.flush()
-                            # Print the incoming message
-                            print(message)
-                            # Reprint prompt and input buffer only if username is set
-                            if username is not None:
-                                prompt = f"{username}: "
-                                sys.stdout.write(prompt + input_buffer)
-                                sys.stdout.flush()
+                        if last_id != saved_id and (
+                            time.monotonic() - saved_at >= STATE_SAVE_INTERVAL
+                        ):
+                            save_last_id(server_key, last_id)
+                            saved_id = last_id
+                            saved_at = time.monotonic()
                     else:
-                        print("\nServer closed the connection. Goodbye.")
-                        return
+                        clientsocket.close()
+                        recv_buffer = b""
+                        if last_id != saved_id:
+                            save_last_id(server_key, last_id)
+                            saved_id = last_id
+                        clientsocket = reconnect(host, port, last_id, username)
+                        skip_username_prompt = username is not None
+                        prompt_visible = False
+                        break
                 elif s == sys.stdin:
-                    char = os.read(sys.stdin.fileno(), 1).decode(
-                        "utf-8", errors="replace"
+                    chars = input_decoder.decode(
+                        os.read(sys.stdin.fileno(), INPUT_READ_SIZE)
                     )
-                    if char == "\n":
-                        message = input_buffer.strip()
-                        if message:
-                            if username is None:
-                                username = message
-                                clientsocket.sendall((username + "\n").encode("utf-8"))
-                            else:
-                                clientsocket.sendall((message + "\n").encode("utf-8"))
-                                if message.lower() == "quit":
+                    echo = []
+                    for char in chars:
+                        if char == "\n":
+                            message = input_buffer.strip()
+                            input_buffer = ""
+                            echo.append("\n")
+                            if message:
+                                try:
+                                    clientsocket.sendall(
+                                        (message + "\n").encode("utf-8")
+                                    )
+                                except OSError:
+                                    # The receive side notices the lost connection
+                                    pass
+                                if username is None:
+                                    username = message
+                                elif message.lower() == "quit":
+                                    sys.stdout.write("".join(echo))
                                     print("\nExiting chat. Goodbye.")
                                     return
-                        input_buffer = ""
-                        sys.stdout.write("\n")
-                        if username is not None:
-                            prompt = f"{username}: "
-                            sys.stdout.write(prompt)
-                            sys.stdout.flush()
-                    elif char == "\x7f":  # Backspace
-                        if len(input_buffer) > 0:
-                            input_buffer = input_buffer[:-1]
-                            # Move cursor back, overwrite character with space, move cursor back
-                            sys.stdout.write("\b \b")
-                            sys.stdout.flush()
-                    else:
-                        input_buffer += char
-                        sys.stdout.write(char)
+                            if username is not None:
+                                echo.append(f"{username}: ")
+                        elif char == "\x7f":  # Backspace
+                            if len(input_buffer) > 0:
+                                input_buffer = input_buffer[:-1]
+                                # Move cursor back, overwrite character with space, move cursor back
+                                echo.append("\b \b")
+                        else:
+                            input_buffer += char
+                            echo.append(char)
+                    if echo:
+                        sys.stdout.write("".join(echo))
                         sys.stdout.flush()
+                    prompt_visible = username is not None or bool(input_buffer)
     except KeyboardInterrupt:
         print("\nExiting chat. Goodbye.")
     except Exception as e:
@@ -119,6 +230,8 @@ def init_client():
         # Restore terminal settings
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, original_settings)
         clientsocket.close()
+        if last_id != saved_id:
+            save_last_id(server_key, last_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,429 @@
+"""End-to-end load generator for the chat server and web server.
+
+Starts server.py and webserver.py on localhost against a throwaway database,
+then drives them with simulated browser sessions polling /api/messages,
+senders posting messages, and raw TCP clients speaking the client.py
+protocol. Prints (or writes) a JSON report with throughput and latency
+percentiles per endpoint so runs can be compared between releases.
+
+Example:
+    python3 loadtest.py --pollers 50 --senders 10 --tcp-clients 20 --duration 30
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCALHOST = "127.0.0.1"
+
+
+class LatencyRecorder:
+    """Collects per-endpoint samples; each worker thread owns its own lists."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def worker(self):
+        samples = {}
+        errors = {}
+        with self.lock:
+            self.samples[threading.get_ident()] = samples
+            self.errors[threading.get_ident()] = errors
+        return samples, errors
+
+    def merged(self):
+        samples = {}
+        errors = {}
+        with self.lock:
+            for per_thread in self.samples.values():
+                for endpoint, values in per_thread.items():
+                    samples.setdefault(endpoint, []).extend(values)
+            for per_thread in self.errors.values():
+                for endpoint, count in per_thread.items():
+                    errors[endpoint] = errors.get(endpoint, 0) + count
+        return samples, errors
+
+
+def record(samples, endpoint, seconds):
+    samples.setdefault(endpoint, []).append(seconds)
+
+
+def record_error(errors, endpoint):
+    errors[endpoint] = errors.get(endpoint, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(
+        0, min(len(sorted_values) - 1, int(fraction * len(sorted_values) + 0.5) - 1)
+    )
+    return sorted_values[index]
+
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((LOCALHOST, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def start_servers(args, workdir):
+    env = dict(os.environ)
+    env.update(
+        {
+            "CHAT_SERVER_HOST": LOCALHOST,
+            "CHAT_SERVER_PORT": str(args.chat_port),
+            "CHAT_DATABASE_PATH": os.path.join(workdir, "loadtest.db"),
+            "CHAT_ARCHIVE_DIR": os.path.join(workdir, "archive"),
+            "WEB_SERVER_HOST": LOCALHOST,
+            "WEB_SERVER_PORT": str(args.web_port),
+            "WEB_SERVER_WORKERS": str(args.web_workers),
+            "WEB_SESSION_DATABASE_PATH": os.path.join(workdir, "sessions.db"),
+        }
+    )
+    output = None if args.server_output else subprocess.DEVNULL
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, "server.py")],
+            cwd=REPO_DIR,
+            env=env,
+            stdout=output,
+            stderr=output,
+        )
+    ]
+    if not wait_for_port(args.chat_port, 10):
+        stop_servers(processes)
+        raise RuntimeError(f"Chat server did not start on port {args.chat_port}")
+    processes.append(
+        subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, "webserver.py")],
+            cwd=REPO_DIR,
+            env=env,
+            stdout=output,
+            stderr=output,
+        )
+    )
+    if not wait_for_port(args.web_port, 10):
+        stop_servers(processes)
+        raise RuntimeError(f"Web server did not start on port {args.web_port}")
+    return processes
+
+
+def stop_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def http_request(args, method, path, body=None, cookie=None):
+    conn = http.client.HTTPConnection(LOCALHOST, args.web_port, timeout=args.timeout)
+    try:
+        headers = {}
+        if cookie:
+            headers["Cookie"] = cookie
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        payload = response.read()
+        return response.status, response.getheader("Set-Cookie"), payload
+    finally:
+        conn.close()
+
+
+def login(args, username):
+    status, set_cookie, _ = http_request(
+        args, "POST", "/api/login", {"username": username}
+    )
+    if status != 200 or not set_cookie:
+        raise RuntimeError(f"Login failed for {username} with status {status}")
+    return set_cookie.split(";", 1)[0]
+
+
+def timed_http(args, samples, errors, endpoint, method, path, body=None, cookie=None):
+    start = time.perf_counter()
+    try:
+        status, _, payload = http_request(args, method, path, body, cookie)
+    except (OSError, http.client.HTTPException):
+        record_error(errors, endpoint)
+        return None
+    record(samples, endpoint, time.perf_counter() - start)
+    if status != 200:
+        record_error(errors, endpoint)
+        return None
+    return payload
+
+
+def poller(args, recorder, index, stop_event):
+    samples, errors = recorder.worker()
+    try:
+        cookie = login(args, f"poller{index}")
+    except (OSError, RuntimeError, http.client.HTTPException):
+        record_error(errors, "POST /api/login")
+        return
+    last_id = 0
+    while not stop_event.is_set():
+        payload = timed_http(
+            args,
+            samples,
+            errors,
+            "GET /api/messages",
+            "GET",
+            f"/api/messages?last={last_id}",
+            cookie=cookie,
+        )
+        if payload:
+            try:
+                messages = json.loads(payload)
+            except ValueError:
+                messages = []
+            if messages:
+                last_id = messages[-1]["id"]
+        stop_event.wait(args.poll_interval)
+
+
+def sender(args, recorder, index, stop_event):
+    samples, errors = recorder.worker()
+    try:
+        cookie = login(args, f"sender{index}")
+    except (OSError, RuntimeError, http.client.HTTPException):
+        record_error(errors, "POST /api/login")
+        return
+    sequence = 0
+    while not stop_event.is_set():
+        sequence += 1
+        # The send timestamp lets TCP clients measure fan-out delay
+        message = f"loadtest {time.time():.6f} sender{index} #{sequence}"
+        timed_http(
+            args,
+            samples,
+            errors,
+            "POST /api/messages",
+            "POST",
+            "/api/messages",
+            body={"message": message},
+            cookie=cookie,
+        )
+        stop_event.wait(args.send_interval)
+
+
+def tcp_client(args, recorder, index, stop_event, received_counts):
+    samples, errors = recorder.worker()
+    start = time.perf_counter()
+    try:
+        sock = socket.create_connection(
+            (LOCALHOST, args.chat_port), timeout=args.timeout
+        )
+    except OSError:
+        record_error(errors, "TCP connect")
+        return
+    try:
+        buffer = b""
+        while b"Enter your username:" not in buffer:
+            chunk = sock.recv(4096)
+            if not chunk:
+                record_error(errors, "TCP connect")
+                return
+            buffer += chunk
+        sock.sendall(f"tcpclient{index}\n".encode("utf-8"))
+        record(samples, "TCP connect", time.perf_counter() - start)
+        buffer = b""
+        received = 0
+        sock.setblocking(False)
+        while not stop_event.is_set():
+            ready, _, _ = select.select([sock], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                chunk = sock.recv(65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                record_error(errors, "TCP fan-out")
+                return
+            buffer += chunk
+            now = time.time()
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                received += 1
+                parts = line.split(b" ", 3)
+                # Lines look like "senderN: loadtest <timestamp> ..."
+                if len(parts) >= 3 and parts[1] == b"loadtest":
+                    try:
+                        record(samples, "TCP fan-out", now - float(parts[2]))
+                    except ValueError:
+                        pass
+        received_counts[index] = received
+    except OSError:
+        record_error(errors, "TCP fan-out")
+    finally:
+        sock.close()
+
+
+def summarize(recorder, duration):
+    samples, errors = recorder.merged()
+    endpoints = {}
+    for endpoint in sorted(set(samples) | set(errors)):
+        values = sorted(samples.get(endpoint, []))
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": errors.get(endpoint, 0),
+            "throughput_per_second": round(len(values) / duration, 3),
+            "mean_ms": round(1000 * sum(values) / len(values), 3) if values else None,
+            "p50_ms": ms(percentile(values, 0.50)),
+            "p95_ms": ms(percentile(values, 0.95)),
+            "p99_ms": ms(percentile(values, 0.99)),
+            "max_ms": ms(values[-1] if values else None),
+        }
+    return endpoints
+
+
+def ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def run_load(args):
+    recorder = LatencyRecorder()
+    stop_event = threading.Event()
+    received_counts = {}
+    threads = []
+    for index in range(args.tcp_clients):
+        threads.append(
+            threading.Thread(
+                target=tcp_client,
+                args=(args, recorder, index, stop_event, received_counts),
+                daemon=True,
+            )
+        )
+    for index in range(args.pollers):
+        threads.append(
+            threading.Thread(
+                target=poller, args=(args, recorder, index, stop_event), daemon=True
+            )
+        )
+    for index in range(args.senders):
+        threads.append(
+            threading.Thread(
+                target=sender, args=(args, recorder, index, stop_event), daemon=True
+            )
+        )
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join(args.timeout + 1)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "pollers": args.pollers,
+            "senders": args.senders,
+            "tcp_clients": args.tcp_clients,
+            "duration_seconds": args.duration,
+            "poll_interval_seconds": args.poll_interval,
+            "send_interval_seconds": args.send_interval,
+            "web_workers": args.web_workers,
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "endpoints": summarize(recorder, elapsed),
+        "tcp_lines_received": sum(received_counts.values()),
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--pollers", type=int, default=10, help="browser sessions polling /api/messages"
+    )
+    parser.add_argument(
+        "--senders", type=int, default=2, help="sessions posting messages"
+    )
+    parser.add_argument(
+        "--tcp-clients", type=int, default=5, help="raw client.py protocol connections"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds to generate load"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=2.0,
+        help="seconds between polls (index.html uses 2)",
+    )
+    parser.add_argument(
+        "--send-interval",
+        type=float,
+        default=0.5,
+        help="seconds between posts per sender",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10.0, help="per-request timeout in seconds"
+    )
+    parser.add_argument("--chat-port", type=int, default=18635)
+    parser.add_argument("--web-port", type=int, default=18636)
+    parser.add_argument(
+        "--web-workers", type=int, default=1, help="web server worker processes"
+    )
+    parser.add_argument(
+        "--no-spawn",
+        action="store_true",
+        help="drive servers that are already running on the given localhost ports",
+    )
+    parser.add_argument("--server-output", action="store_true", help="show server logs")
+    parser.add_argument(
+        "--output", help="write the JSON report to this file instead of stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="chat-loadtest-") as workdir:
+        processes = [] if args.no_spawn else start_servers(args, workdir)
+        try:
+            report = run_load(args)
+        finally:
+            stop_servers(processes)
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json + "\n")
+    else:
+        print(report_json)
+    total_errors = sum(stats["errors"] for stats in report["endpoints"].values())
+    return 1 if total_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
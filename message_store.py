@@ -0,0 +1,189 @@
+import array
+import bisect
+import json
+
+# Deleted rows are only dropped from the columns once there are this many
+# and they outnumber the live ones
+COMPACT_MIN_DELETED = 1024
+
+DELETED = -1
+
+
+class MessageStore:
+    """Messages held in id order as parallel array columns.
+
+    Each message costs 24 bytes of columns plus its JSON-encoded text in a
+    shared bytes arena, instead of a dict and two str objects. Usernames are
+    stored once and referenced by number. Because the arena already holds
+    JSON, a range of messages is emitted by joining byte slices.
+
+    Not thread-safe; callers hold their own lock.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = array.array("q")
+        # Index into self.usernames, or DELETED
+        self.users = array.array("i")
+        self.offsets = array.array("q")
+        self.lengths = array.array("i")
+        self.arena = bytearray()
+        # JSON-encoded usernames and the number of each
+        self.usernames = []
+        self.username_numbers = {}
+        self.deleted_count = 0
+
+    def __len__(self):
+        return len(self.ids) - self.deleted_count
+
+    def __contains__(self, message_id):
+        return self.position(message_id) is not None
+
+    def position(self, message_id):
+        """Column position of a live message, or None."""
+        position = bisect.bisect_left(self.ids, message_id)
+        if (
+            position < len(self.ids)
+            and self.ids[position] == message_id
+            and self.users[position] != DELETED
+        ):
+            return position
+        return None
+
+    def position_after(self, last_id):
+        return bisect.bisect_right(self.ids, last_id)
+
+    def add(self, message_id, username, message):
+        """Store a message; returns False if the id is already present."""
+        user = self.username_numbers.get(username)
+        if user is None:
+            user = len(self.usernames)
+            self.usernames.append(json.dumps(username).encode("ascii"))
+            self.username_numbers[username] = user
+        body = json.dumps(message).encode("ascii")
+        offset = len(self.arena)
+        self.arena += body
+        if not self.ids or message_id > self.ids[-1]:
+            self.ids.append(message_id)
+            self.users.append(user)
+            self.offsets.append(offset)
+            self.lengths.append(len(body))
+            return True
+        # Out of order: the id of a deleted message was reused, or a replayed
+        # message is already here
+        position = bisect.bisect_left(self.ids, message_id)
+        if self.ids[position] == message_id:
+            if self.users[position] != DELETED:
+                del self.arena[offset:]
+                return False
+            self.deleted_count -= 1
+            self.users[position] = user
+            self.offsets[position] = offset
+            self.lengths[position] = len(body)
+            return True
+        self.ids.insert(position, message_id)
+        self.users.insert(position, user)
+        self.offsets.insert(position, offset)
+        self.lengths.insert(position, len(body))
+        return True
+
+    def remove(self, message_id):
+        """Delete a message; returns False if it was not present."""
+        position = self.position(message_id)
+        if position is None:
+            return False
+        self.users[position] = DELETED
+        self.deleted_count += 1
+        if self.deleted_count >= COMPACT_MIN_DELETED and self.deleted_count > len(self):
+            self.compact()
+        return True
+
+    def tail_position(self, count):
+        """Column position where the newest count live messages start."""
+        start = len(self.ids)
+        live = 0
+        while live < count and start > 0:
+            start -= 1
+            if self.users[start] != DELETED:
+                live += 1
+        return start
+
+    def trim(self, keep):
+        """Drop all but the newest keep messages; returns the highest id dropped.
+
+        Returns None if there was nothing to drop.
+        """
+        if len(self) <= keep:
+            return None
+        start = self.tail_position(keep)
+        dropped_id = self.ids[start - 1]
+        del self.ids[:start]
+        del self.users[:start]
+        del self.offsets[:start]
+        del self.lengths[:start]
+        self.compact()
+        return dropped_id
+
+    def compact(self):
+        """Drop deleted rows from the columns and their text from the arena."""
+        ids, users = array.array("q"), array.array("i")
+        offsets, lengths = array.array("q"), array.array("i")
+        arena = bytearray()
+        for position in range(len(self.ids)):
+            if self.users[position] == DELETED:
+                continue
+            offset, length = self.offsets[position], self.lengths[position]
+            ids.append(self.ids[position])
+            users.append(self.users[position])
+            offsets.append(len(arena))
+            lengths.append(length)
+            arena += self.arena[offset : offset + length]
+        self.ids, self.users = ids, users
+        self.offsets, self.lengths = offsets, lengths
+        self.arena = arena
+        self.deleted_count = 0
+
+    def message_json(self, position):
+        """The message at a column position as a JSON object, in bytes."""
+        offset = self.offsets[position]
+        return b'{"id": %d, "username": %s, "message": %s}' % (
+            self.ids[position],
+            self.usernames[self.users[position]],
+            self.arena[offset : offset + self.lengths[position]],
+        )
+
+    def positions(self, start=0, limit=None):
+        """Yield live column positions from start on, at most limit of them."""
+        count = 0
+        for position in range(start, len(self.ids)):
+            if limit is not None and count >= limit:
+                return
+            if self.users[position] != DELETED:
+                count += 1
+                yield position
+
+    def json_range(self, start=0, limit=None):
+        """A JSON array of the messages positions() selects, in bytes."""
+        ids, users, usernames = self.ids, self.users, self.usernames
+        offsets, lengths, arena = self.offsets, self.lengths, self.arena
+        parts = []
+        for position in self.positions(start, limit):
+            offset = offsets[position]
+            parts.append(
+                b'{"id": %d, "username": %s, "message": %s}'
+                % (
+                    ids[position],
+                    usernames[users[position]],
+                    arena[offset : offset + lengths[position]],
+                )
+            )
+        return b"[" + b", ".join(parts) + b"]"
+
+    def messages(self, start=0, limit=None):
+        """The messages positions() selects, as id/username/message dicts."""
+        return [
+            json.loads(self.message_json(position))
+            for position in self.positions(start, limit)
+        ]
@@ -0,0 +1,271 @@
+import bisect
+import threading
+
+# Fixed latency buckets (seconds) shared by every histogram unless overridden
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# Fold the shards of finished threads back once this many have piled up
+SHARD_FOLD_THRESHOLD = 64
+
+registered_metrics = []
+registry_lock = threading.Lock()
+
+
+class _ShardedValues:
+    """Per-thread value tables merged only when the metrics are scraped.
+
+    Every thread writes to its own dict, so recording never takes a lock.
+    Shards belonging to threads that have exited are folded into a base
+    table so thread-per-connection servers do not accumulate them forever.
+    """
+
+    def __init__(self, new_value, merge_value):
+        self._new_value = new_value
+        self._merge_value = merge_value
+        self._local = threading.local()
+        self._shards = []
+        self._base = {}
+        self._lock = threading.Lock()
+
+    def local(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            with self._lock:
+                if len(self._shards) >= SHARD_FOLD_THRESHOLD:
+                    self._fold_dead_shards()
+                self._shards.append((threading.current_thread(), values))
+            self._local.values = values
+            return values
+
+    def _fold_dead_shards(self):
+        live_shards = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                live_shards.append((thread, values))
+            else:
+                self._merge_into(self._base, values)
+        self._shards = live_shards
+
+    def _merge_into(self, target, values):
+        for labels, value in values.items():
+            if labels in target:
+                target[labels] = self._merge_value(target[labels], value)
+            else:
+                target[labels] = self._merge_value(self._new_value(), value)
+
+    def snapshot(self):
+        with self._lock:
+            self._fold_dead_shards()
+            merged = {}
+            self._merge_into(merged, self._base)
+            for _, values in self._shards:
+                # dict.copy() is atomic under the GIL, so a writer cannot
+                # resize the table while it is being read
+                self._merge_into(merged, values.copy())
+        return merged
+
+
+def _add(a, b):
+    return a + b
+
+
+def _add_lists(a, b):
+    return [x + y for x, y in zip(a, b)]
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = _ShardedValues(int, _add)
+        register_metric(self)
+
+    def inc(self, labels=(), amount=1):
+        values = self._values.local()
+        values[labels] = values.get(labels, 0) + amount
+
+    def snapshot(self):
+        return {"type": "counter", "values": self._values.snapshot()}
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # One slot per bucket, one for +Inf and one for the running sum
+        self._width = len(self.buckets) + 2
+        self._values = _ShardedValues(lambda: [0] * self._width, _add_lists)
+        register_metric(self)
+
+    def observe(self, value, labels=()):
+        values = self._values.local()
+        slots = values.get(labels)
+        if slots is None:
+            slots = values[labels] = [0] * self._width
+        slots[bisect.bisect_left(self.buckets, value)] += 1
+        slots[-1] += value
+
+    def snapshot(self):
+        return {
+            "type": "histogram",
+            "buckets": self.buckets,
+            "values": self._values.snapshot(),
+        }
+
+
+class Gauge:
+    """A gauge whose samples are produced by a callback at scrape time."""
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        register_metric(self)
+
+    def snapshot(self):
+        values = {}
+        if self.callback is not None:
+            for labels, value in self.callback():
+                values[labels] = value
+        return {"type": "gauge", "values": values}
+
+
+def register_metric(metric):
+    with registry_lock:
+        registered_metrics.append(metric)
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    rendered = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for key, value in pairs
+    )
+    return "{" + rendered + "}"
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def collect_metrics():
+    """Return every registered metric's current values as JSON-friendly dicts.
+
+    Collections from several processes can be combined with merge_collected()
+    and rendered with render_collected().
+    """
+    with registry_lock:
+        metrics = list(registered_metrics)
+    collected = []
+    for metric in metrics:
+        snapshot = metric.snapshot()
+        collected.append(
+            {
+                "name": metric.name,
+                "help": metric.help_text,
+                "type": snapshot["type"],
+                "labelnames": list(metric.labelnames),
+                "buckets": list(snapshot.get("buckets", ())),
+                "values": [
+                    [list(labels), value]
+                    for labels, value in snapshot["values"].items()
+                ],
+            }
+        )
+    return collected
+
+
+def merge_collected(collections):
+    """Combine several collect_metrics() results, e.g. one per worker process.
+
+    Counters and histograms are summed. Gauges are states rather than totals,
+    so the highest value is kept.
+    """
+    merged = {}
+    for collected in collections:
+        for metric in collected:
+            entry = merged.get(metric["name"])
+            if entry is None:
+                entry = merged[metric["name"]] = dict(metric, values={})
+            values = entry["values"]
+            for labels, value in metric["values"]:
+                labels = tuple(labels)
+                if labels not in values:
+                    values[labels] = value
+                elif metric["type"] == "histogram":
+                    values[labels] = _add_lists(values[labels], value)
+                elif metric["type"] == "gauge":
+                    values[labels] = max(values[labels], value)
+                else:
+                    values[labels] += value
+    for entry in merged.values():
+        entry["values"] = [
+            [list(labels), value] for labels, value in entry["values"].items()
+        ]
+    return list(merged.values())
+
+
+def render_metric(metric):
+    name = metric["name"]
+    labelnames = metric["labelnames"]
+    lines = [
+        f"# HELP {name} {metric['help']}",
+        f"# TYPE {name} {metric['type']}",
+    ]
+    for labels, value in sorted(metric["values"]):
+        if metric["type"] != "histogram":
+            lines.append(
+                f"{name}{format_labels(labelnames, labels)} {format_number(value)}"
+            )
+            continue
+        cumulative = 0
+        for bound, count in zip(metric["buckets"], value):
+            cumulative += count
+            le = format_labels(labelnames, labels, [("le", bound)])
+            lines.append(f"{name}_bucket{le} {cumulative}")
+        cumulative += value[-2]
+        le = format_labels(labelnames, labels, [("le", "+Inf")])
+        lines.append(f"{name}_bucket{le} {cumulative}")
+        label_text = format_labels(labelnames, labels)
+        lines.append(f"{name}_sum{label_text} {format_number(value[-1])}")
+        lines.append(f"{name}_count{label_text} {cumulative}")
+    return lines
+
+
+def render_collected(collected):
+    lines = []
+    for metric in collected:
+        lines.extend(render_metric(metric))
+    return "\n".join(lines) + "\n"
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text format."""
+    return render_collected(collect_metrics())
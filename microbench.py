@@ -0,0 +1,466 @@
+"""Micro-benchmarks for the hot functions in webserver.py and server.py.
+
+Each benchmark is timed with the best of several repeats and compared
+against microbench_baseline.json. A benchmark that is slower than its
+baseline by more than the allowed tolerance, and by more than a fixed
+noise floor, is reported as a regression and the script exits with
+status 1. Benchmarks that wait on fsync or the chat server vary more from
+run to run and get a looser tolerance.
+
+Examples:
+    python3 microbench.py                      # compare against the baseline
+    python3 microbench.py --filter server.     # only the chat server benchmarks
+    python3 microbench.py --update-baseline    # record new baseline numbers
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(REPO_DIR, "microbench_baseline.json")
+DEFAULT_TOLERANCE = 0.5
+IO_TOLERANCE = 1.5
+# Slowdowns smaller than this are timer and scheduler noise at any percentage
+NOISE_FLOOR = 5e-6
+
+ROW_COUNTS = (10, 1000, 100000)
+STORAGE_BACKENDS = ("sqlite", "segment")
+CLIENT_COUNTS = (1, 100, 10000)
+
+benchmarks = []
+# Names of benchmarks bound by disk syncs or chat server round trips
+io_bound_benchmarks = set()
+
+
+def benchmark(name, io_bound=False):
+    """Register a setup function returning the callable to time."""
+
+    def register(setup):
+        benchmarks.append((name, setup))
+        if io_bound:
+            io_bound_benchmarks.add(name)
+        return setup
+
+    return register
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# The servers read their configuration at import time
+WORK_DIR = tempfile.mkdtemp(prefix="chat-microbench-")
+os.environ["CHAT_SERVER_HOST"] = "127.0.0.1"
+os.environ["CHAT_SERVER_PORT"] = str(free_port())
+os.environ["CHAT_DATABASE_PATH"] = os.path.join(WORK_DIR, "chat.db")
+os.environ["CHAT_ARCHIVE_DIR"] = os.path.join(WORK_DIR, "archive")
+os.environ["WEB_SESSION_DATABASE_PATH"] = os.path.join(WORK_DIR, "sessions.db")
+sys.path.insert(0, REPO_DIR)
+
+import message_store  # noqa: E402
+import replica  # noqa: E402
+import server  # noqa: E402
+import webserver  # noqa: E402
+from segment_log import SegmentLog  # noqa: E402
+
+
+class NullSocket:
+    """Stands in for a connected client so fan-out cost excludes the kernel."""
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def segment_log_with_rows(row_count):
+    directory = tempfile.mkdtemp(prefix=f"segments-{row_count}-", dir=WORK_DIR)
+    segment_log = SegmentLog(directory)
+    rows = [
+        (f"user{i % 50}", f"benchmark message number {i}") for i in range(row_count)
+    ]
+    for start in range(0, row_count, 10000):
+        segment_log.append_many(rows[start : start + 10000])
+    return segment_log
+
+
+def database_with_rows(row_count, backend="sqlite"):
+    if backend == "segment":
+        return segment_log_with_rows(row_count)
+    path = os.path.join(WORK_DIR, f"rows-{row_count}.db")
+    if os.path.exists(path):
+        os.remove(path)
+    server.DATABASE_PATH = path
+    connection = server.initialize_database()
+    connection.executemany(
+        "INSERT INTO messages (username, message, seq) VALUES (?, ?, ?)",
+        (
+            (f"user{i % 50}", f"benchmark message number {i}", i + 1)
+            for i in range(row_count)
+        ),
+    )
+    connection.commit()
+    server.change_seq = row_count
+    return connection
+
+
+def start_chat_server():
+    server.DATABASE_PATH = os.environ["CHAT_DATABASE_PATH"]
+    threading.Thread(target=server.main, daemon=True).start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(
+                (webserver.CHAT_SERVER_HOST, webserver.CHAT_SERVER_PORT), timeout=0.5
+            ):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Chat server did not start for the benchmarks")
+
+
+def web_session(username):
+    session_id = f"bench-{username}"
+    webserver.store_session(session_id, username)
+    return {"Cookie": f"theme=dark; session_id={session_id}", "Path": "/api/messages"}
+
+
+# webserver.py
+
+
+@benchmark("webserver.parse_http_request")
+def bench_parse_http_request():
+    request = (
+        b"POST /api/messages HTTP/1.1\r\n"
+        b"Host: localhost:8636\r\n"
+        b"User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n"
+        b"Accept: */*\r\n"
+        b"Accept-Language: en-US,en;q=0.5\r\n"
+        b"Content-Type: application/json\r\n"
+        b"Content-Length: 27\r\n"
+        b"Cookie: theme=dark; session_id=0f8fad5b-d9cb-469f-a165-70867728950e\r\n"
+        b"\r\n"
+        b'{"message": "hello world"}'
+    )
+    return lambda: webserver.parse_http_request(request)
+
+
+@benchmark("webserver.parse_cookie_header")
+def bench_parse_cookie_header():
+    header = "theme=dark; lang=en; session_id=0f8fad5b-d9cb-469f-a165-70867728950e"
+    return lambda: webserver.parse_cookie_header(header)
+
+
+@benchmark("webserver.serve_static_file")
+def bench_serve_static_file():
+    path = os.path.join(REPO_DIR, "index.html")
+    return lambda: webserver.serve_static_file(path, {})
+
+
+@benchmark("webserver.api_user_login")
+def bench_api_user_login():
+    return lambda: webserver.api_user_login({}, '{"username": "bench"}')
+
+
+@benchmark("webserver.api_check_user_login")
+def bench_api_check_user_login():
+    headers = web_session("bench")
+    return lambda: webserver.api_check_user_login(headers)
+
+
+@benchmark("webserver.api_retrieve_messages", io_bound=True)
+def bench_api_retrieve_messages():
+    headers = web_session("bench")
+    headers["Path"] = "/api/messages?last=0"
+    return lambda: webserver.api_retrieve_messages(headers)
+
+
+@benchmark("webserver.api_send_message", io_bound=True)
+def bench_api_send_message():
+    headers = web_session("bench")
+    return lambda: webserver.api_send_message(headers, '{"message": "benchmark"}')
+
+
+@benchmark("webserver.api_remove_message", io_bound=True)
+def bench_api_remove_message():
+    headers = web_session("bench")
+    # Deleting a message owned by someone else exercises the full round trip
+    return lambda: webserver.api_remove_message("DELETE", "/api/messages/1", headers)
+
+
+@benchmark("webserver.fetch_messages_json_roundtrip[1000]")
+def bench_fetch_messages_json_roundtrip():
+    messages = [
+        {"id": i, "username": f"user{i % 50}", "message": f"benchmark message {i}"}
+        for i in range(1000)
+    ]
+
+    def roundtrip():
+        # Encoding on the chat server followed by decoding in the web server
+        payload = json.dumps(messages).encode("utf-8")
+        return json.loads(payload.decode("utf-8"))
+
+    return roundtrip
+
+
+def bench_replica_changes_tail(row_count):
+    # A browser poll answered by the web server's replica, ten changes behind
+    message_replica = replica.MessageReplica()
+    message_replica.load({"seq": 0, "reset": True, "messages": [], "deleted": []})
+    for i in range(1, row_count + 1):
+        message_replica.apply(
+            {"seq": i, "id": i, "username": f"user{i % 50}", "message": f"number {i}"}
+        )
+    since = max(row_count - 10, 1)
+    return lambda: message_replica.changes_since(since)
+
+
+def bench_message_store_json_range(row_count):
+    store = message_store.MessageStore()
+    for i in range(1, row_count + 1):
+        store.add(i, f"user{i % 50}", f"benchmark message number {i}")
+    return lambda: store.json_range()
+
+
+for _rows in ROW_COUNTS:
+    benchmark(f"webserver.replica_changes_since[{_rows}]")(
+        lambda rows=_rows: bench_replica_changes_tail(rows)
+    )
+for _rows in ROW_COUNTS:
+    benchmark(f"webserver.message_store_json_range[{_rows}]")(
+        lambda rows=_rows: bench_message_store_json_range(rows)
+    )
+
+
+# server.py
+
+
+def bench_get_messages_since_id(row_count, backend="sqlite"):
+    connection = database_with_rows(row_count, backend)
+    return lambda: server.get_messages_since_id(connection, 0)
+
+
+def bench_get_messages_tail(row_count, backend):
+    # A poll that only needs the newest few messages
+    connection = database_with_rows(row_count, backend)
+    last_id = max(row_count - 10, 0)
+    return lambda: server.get_messages_since_id(connection, last_id)
+
+
+def bench_get_changes_tail(row_count):
+    # A browser poll with the change feed, ten messages behind
+    connection = database_with_rows(row_count)
+    since = max(row_count - 10, 1)
+    return lambda: server.get_changes_since(connection, since)
+
+
+def bench_get_user_messages(row_count):
+    # The newest page of one user's history
+    connection = database_with_rows(row_count)
+    return lambda: server.get_user_messages(connection, "user7", 0, 50)
+
+
+def bench_store_message(row_count, backend="sqlite"):
+    connection = database_with_rows(row_count, backend)
+    return lambda: server.store_message(connection, "bench", "benchmark message")
+
+
+def bench_store_messages(batch_size):
+    connection = database_with_rows(1000)
+    batch = [("bench", f"benchmark message {i}") for i in range(batch_size)]
+    return lambda: server.store_messages(connection, batch)
+
+
+def bench_search_messages(row_count):
+    connection = database_with_rows(row_count)
+    query = f"number {row_count // 2}"
+    return lambda: server.search_messages(connection, query, 20, 0)
+
+
+def bench_distribute_message(client_count):
+    clients = [
+        {
+            "socket": NullSocket(),
+            "username": f"user{i}",
+            "address": f"10.0.0.1:{i}",
+            "resume": False,
+        }
+        for i in range(client_count)
+    ]
+
+    def distribute():
+        with server.clients_lock:
+            server.active_clients[:] = clients
+        server.distribute_message(None, sender_username="bench", message="hello")
+
+    return distribute
+
+
+for _rows in ROW_COUNTS:
+    benchmark(f"server.get_messages_since_id[{_rows}]")(
+        lambda rows=_rows: bench_get_messages_since_id(rows)
+    )
+for _rows in ROW_COUNTS:
+    benchmark(f"server.get_changes_since[{_rows}]")(
+        lambda rows=_rows: bench_get_changes_tail(rows)
+    )
+for _rows in ROW_COUNTS:
+    benchmark(f"server.get_user_messages[{_rows}]")(
+        lambda rows=_rows: bench_get_user_messages(rows)
+    )
+for _rows in ROW_COUNTS:
+    benchmark(f"server.store_message[{_rows}]", io_bound=True)(
+        lambda rows=_rows: bench_store_message(rows)
+    )
+for _batch in (10, 100):
+    benchmark(f"server.store_messages[batch={_batch}]", io_bound=True)(
+        lambda batch=_batch: bench_store_messages(batch)
+    )
+for _rows in ROW_COUNTS:
+    benchmark(f"server.search_messages[{_rows}]")(
+        lambda rows=_rows: bench_search_messages(rows)
+    )
+for _clients in CLIENT_COUNTS:
+    benchmark(f"server.distribute_message[{_clients}]")(
+        lambda clients=_clients: bench_distribute_message(clients)
+    )
+
+# The same storage operations against each backend, for comparison
+for _backend in STORAGE_BACKENDS:
+    benchmark(f"storage.{_backend}.read_all[100000]")(
+        lambda backend=_backend: bench_get_messages_since_id(100000, backend)
+    )
+    benchmark(f"storage.{_backend}.read_tail[100000]")(
+        lambda backend=_backend: bench_get_messages_tail(100000, backend)
+    )
+    benchmark(f"storage.{_backend}.store[100000]", io_bound=True)(
+        lambda backend=_backend: bench_store_message(100000, backend)
+    )
+
+
+def time_callable(func, min_time, repeats):
+    """Return the best seconds-per-call over several calibrated repeats."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed / number
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"results": {}}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--filter", default="", help="only run benchmarks whose name starts with this"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--min-time", type=float, default=0.05, help="seconds per timed repeat"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="allowed slowdown versus the baseline (0.5 = 50%%)",
+    )
+    parser.add_argument(
+        "--io-tolerance",
+        type=float,
+        default=IO_TOLERANCE,
+        help="allowed slowdown for benchmarks bound by fsync or the chat server",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = load_baseline()
+    selected = [
+        (name, setup) for name, setup in benchmarks if name.startswith(args.filter)
+    ]
+
+    if any(name.startswith("webserver.api_") for name, _ in selected):
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start_chat_server()
+
+    results = {}
+    regressions = []
+    for name, setup in selected:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            func = setup()
+            seconds = time_callable(func, args.min_time, args.repeats)
+        results[name] = seconds
+        line = f"{name:<55} {seconds * 1e6:>12.2f} us"
+        previous = baseline["results"].get(name)
+        if previous:
+            change = seconds / previous - 1
+            line += f"  ({change:+.0%} vs baseline)"
+            if name in io_bound_benchmarks:
+                tolerance = args.io_tolerance
+            else:
+                tolerance = args.tolerance
+            if change > tolerance and seconds - previous > NOISE_FLOOR:
+                regressions.append((name, previous, seconds))
+                line += "  REGRESSION"
+        print(line)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.update_baseline:
+        baseline["python"] = report["python"]
+        baseline["platform"] = report["platform"]
+        baseline["results"].update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline updated: {BASELINE_PATH}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed beyond their tolerance:")
+        for name, previous, seconds in regressions:
+            print(f"  {name}: {previous * 1e6:.2f} us -> {seconds * 1e6:.2f} us")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import array
+import bisect
+import json
+import threading
+
+from message_store import MessageStore
+
+# Changes remembered for answering ?since= polls; older cursors get a reset
+CHANGE_LOG_SIZE = 100000
+# Newest messages kept, 0 for all; polls for older ones are left to the
+# chat server
+MAX_MESSAGES = 100000
+# Newest messages in a change feed reset, as on the chat server; 0 for all
+RESET_TAIL = 1000
+
+
+class MessageReplica:
+    """In-memory copy of the chat server's messages, kept current by SUBSCRIBE.
+
+    Messages are held in a MessageStore. A log of recent changes, keyed by the
+    chat server's change seq, lets the replica answer change feed polls itself.
+    Only the newest max_messages messages are kept. Reads that would need older
+    ones return None, and the caller asks the chat server instead.
+    """
+
+    def __init__(
+        self,
+        change_log_size=CHANGE_LOG_SIZE,
+        max_messages=MAX_MESSAGES,
+        reset_tail=RESET_TAIL,
+    ):
+        self.lock = threading.Lock()
+        self.change_log_size = change_log_size
+        self.max_messages = max_messages
+        self.reset_tail = reset_tail
+        self.store = MessageStore()
+        # Messages with ids up to this one may exist but are not held here
+        self.floor_id = 0
+        self.seq = 0
+        # Seq and message id of every change after log_start_seq; the id of a
+        # deletion is stored negated
+        self.change_seqs = array.array("q")
+        self.change_ids = array.array("q")
+        self.log_start_seq = 0
+        # Only a replica with a running subscription may answer requests
+        self.live = False
+
+    def load(self, snapshot):
+        """Apply the GET_CHANGES result that starts every subscription."""
+        with self.lock:
+            if snapshot["reset"]:
+                self.store.clear()
+                # Set when the chat server sent only the newest messages
+                self.floor_id = snapshot.get("floor", 0)
+            for message in snapshot["messages"]:
+                self.store.add(message["id"], message["username"], message["message"])
+            for message_id in snapshot["deleted"]:
+                self.store.remove(message_id)
+            if self.max_messages:
+                self.trim(self.max_messages)
+            self.seq = snapshot["seq"]
+            # The snapshot carries no per-change seqs, so polls from before it
+            # cannot be answered incrementally
+            self.change_seqs = array.array("q")
+            self.change_ids = array.array("q")
+            self.log_start_seq = self.seq
+
+    def apply(self, event):
+        """Apply one streamed change; changes already seen are skipped."""
+        with self.lock:
+            seq = event["seq"]
+            if seq <= self.seq:
+                return
+            self.seq = seq
+            if "deleted" in event:
+                message_id = event["deleted"]
+                self.store.remove(message_id)
+                self.log_change(seq, -message_id)
+            else:
+                message_id = event["id"]
+                self.store.add(message_id, event["username"], event["message"])
+                self.log_change(seq, message_id)
+                # Trimmed in batches so each one copies the columns only once
+                if self.max_messages and (
+                    len(self.store) > self.max_messages + self.max_messages // 4
+                ):
+                    self.trim(self.max_messages)
+
+    def trim(self, keep):
+        dropped_id = self.store.trim(keep)
+        if dropped_id is not None:
+            self.floor_id = max(self.floor_id, dropped_id)
+
+    def reset_json(self):
+        # Caller holds self.lock
+        if self.reset_tail <= 0:
+            if self.floor_id:
+                return None
+            start = 0
+        else:
+            start = self.store.tail_position(self.reset_tail)
+        floor = self.floor_id
+        if start > 0:
+            floor = max(floor, self.store.ids[start - 1])
+        return (
+            b'{"seq": %d, "reset": true, "messages": %s, "deleted": [], "floor": %d}'
+            % (self.seq, self.store.json_range(start), floor)
+        )
+
+    def log_change(self, seq, change_id):
+        self.change_seqs.append(seq)
+        self.change_ids.append(change_id)
+        if len(self.change_ids) > 2 * self.change_log_size:
+            drop = len(self.change_ids) - self.change_log_size
+            self.log_start_seq = self.change_seqs[drop - 1]
+            del self.change_seqs[:drop]
+            del self.change_ids[:drop]
+
+    def messages_since(self, last_id, limit=None):
+        """Same result as GET_MESSAGES <last_id> [limit], as JSON bytes.
+
+        None if messages after last_id may have been trimmed.
+        """
+        if limit is not None and limit <= 0:
+            limit = None
+        with self.lock:
+            if last_id < self.floor_id:
+                return None
+            return self.store.json_range(self.store.position_after(last_id), limit)
+
+    def changes_since(self, since, limit=None):
+        """Same result as GET_CHANGES <since> [limit], as JSON bytes.
+
+        A reset carries the newest reset_tail messages and the highest id
+        older ones may have as "floor". None if a delta needs messages that
+        were trimmed, or a reset of the whole history was asked for and the
+        replica no longer has it.
+        """
+        if limit is not None and limit <= 0:
+            limit = None
+        with self.lock:
+            if since <= 0 or since < self.log_start_seq or since > self.seq:
+                return self.reset_json()
+            seq = self.seq
+            messages = []
+            deleted = []
+            start = bisect.bisect_right(self.change_seqs, since)
+            for index in range(start, len(self.change_ids)):
+                message_id = self.change_ids[index]
+                if message_id < 0:
+                    deleted.append(-message_id)
+                    continue
+                if limit is not None and len(messages) >= limit:
+                    # Stop before this message, like the chat server does;
+                    # limit is at least 1, so index - 1 is a change we read
+                    seq = self.change_seqs[index - 1]
+                    break
+                position = self.store.position(message_id)
+                if position is not None:
+                    messages.append(self.store.message_json(position))
+                elif message_id <= self.floor_id:
+                    return None
+            return b'{"seq": %d, "reset": false, "messages": [%s], "deleted": %s}' % (
+                seq,
+                b", ".join(messages),
+                json.dumps(deleted).encode("ascii"),
+            )
@@ -0,0 +1,448 @@
+import array
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Record layout: message id, kind, username length, message length, then the
+# UTF-8 username and message bytes
+RECORD_HEADER = struct.Struct("<qBHI")
+KIND_MESSAGE = 0
+KIND_TOMBSTONE = 1
+
+# Sparse index entries are (message id, byte offset) pairs of signed 64-bit ints
+INDEX_ENTRY = struct.Struct("<qq")
+
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 64
+DEFAULT_COMPACTION_INTERVAL = 60.0
+
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+class Segment:
+    """One size-capped log file plus its sparse id -> offset index.
+
+    Only the newest segment is appended to. Sealed segments are read through
+    read-only memory maps of both the log and the index file.
+    """
+
+    def __init__(self, directory, base_id):
+        self.base_id = base_id
+        self.log_path = os.path.join(directory, f"{base_id:020d}{LOG_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{base_id:020d}{INDEX_SUFFIX}")
+        self.size = 0
+        self.first_id = None
+        self.last_id = None
+        self.record_count = 0
+        self.has_tombstones = False
+        self.log_fd = None
+        self.index_file = None
+        self.index = array.array("q")
+        self.mapped = None
+        self.mapped_size = 0
+
+    def open_for_append(self):
+        self.log_fd = os.open(
+            self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self.index_file = open(self.index_path, "ab")
+
+    def seal(self, fsync):
+        if self.log_fd is None:
+            return
+        if fsync:
+            os.fsync(self.log_fd)
+        os.close(self.log_fd)
+        self.log_fd = None
+        self.index_file.close()
+        self.index_file = None
+        self.map_index()
+
+    def map_index(self):
+        # Sealed indexes are used straight from the page cache
+        if os.path.getsize(self.index_path) == 0:
+            self.index = array.array("q")
+            return
+        with open(self.index_path, "rb") as f:
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = memoryview(index_map).cast("q")
+
+    def view(self, size):
+        """Return a zero-copy view of the first size bytes of the log."""
+        if size == 0:
+            return memoryview(b"")
+        if self.mapped is None or self.mapped_size < size:
+            with open(self.log_path, "rb") as f:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_size = len(self.mapped)
+        return memoryview(self.mapped)[:size]
+
+    def offset_for(self, after_id):
+        """Byte offset at which to start scanning for ids greater than after_id."""
+        index = self.index
+        low, high = 0, len(index) // 2
+        # Find the last index entry whose id is <= after_id + 1
+        while low < high:
+            middle = (low + high) // 2
+            if index[middle * 2] <= after_id + 1:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return 0
+        return index[(low - 1) * 2 + 1]
+
+    def record_appended(self, message_id, kind, offset, length, index_interval):
+        self.size = offset + length
+        if kind == KIND_TOMBSTONE:
+            self.has_tombstones = True
+            return None
+        if self.first_id is None:
+            self.first_id = message_id
+        self.last_id = message_id
+        self.record_count += 1
+        if (self.record_count - 1) % index_interval == 0:
+            self.index.extend((message_id, offset))
+            return INDEX_ENTRY.pack(message_id, offset)
+        return None
+
+
+def iterate_records(view, offset=0):
+    """Yield (kind, id, username view, message view, offset, length) records."""
+    end = len(view)
+    header_size = RECORD_HEADER.size
+    while offset + header_size <= end:
+        message_id, kind, username_length, message_length = RECORD_HEADER.unpack_from(
+            view, offset
+        )
+        start = offset + header_size
+        stop = start + username_length + message_length
+        if stop > end:
+            # A torn write at the tail of the active segment
+            return
+        yield (
+            kind,
+            message_id,
+            view[start : start + username_length],
+            view[start + username_length : stop],
+            offset,
+            stop - offset,
+        )
+        offset = stop
+
+
+def encode_record(message_id, kind, username=b"", message=b""):
+    return (
+        RECORD_HEADER.pack(message_id, kind, len(username), len(message))
+        + username
+        + message
+    )
+
+
+class SegmentLog:
+    """Append-only message store made of size-capped segment files.
+
+    Messages are appended with increasing ids and read back by id range.
+    Deleting a message appends a tombstone; compaction later rewrites sealed
+    segments without deleted messages or their tombstones.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES,
+        index_interval=DEFAULT_INDEX_INTERVAL,
+        fsync=True,
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        self.deleted_ids = set()
+        self.segments = []
+        self.next_id = 1
+        self.compaction_thread = None
+        os.makedirs(directory, exist_ok=True)
+        self.load_segments()
+
+    def load_segments(self):
+        base_ids = sorted(
+            int(name[: -len(LOG_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(LOG_SUFFIX) and name[: -len(LOG_SUFFIX)].isdigit()
+        )
+        for position, base_id in enumerate(base_ids):
+            segment = Segment(self.directory, base_id)
+            self.recover_segment(segment, is_active=position == len(base_ids) - 1)
+            self.segments.append(segment)
+        if not self.segments:
+            segment = Segment(self.directory, self.next_id)
+            segment.open_for_append()
+            self.segments.append(segment)
+
+    def recover_segment(self, segment, is_active):
+        # Rebuild in-memory state and the index from the log itself
+        file_size = os.path.getsize(segment.log_path)
+        if file_size:
+            with open(segment.log_path, "rb") as f:
+                data = f.read()
+        else:
+            data = b""
+        index_entries = []
+        for kind, message_id, _, _, offset, length in iterate_records(memoryview(data)):
+            entry = segment.record_appended(
+                message_id, kind, offset, length, self.index_interval
+            )
+            if entry:
+                index_entries.append(entry)
+            if kind == KIND_TOMBSTONE:
+                self.deleted_ids.add(message_id)
+            self.next_id = max(self.next_id, message_id + 1)
+        if segment.size < file_size:
+            print(f"Truncating torn record at the end of {segment.log_path}")
+            os.truncate(segment.log_path, segment.size)
+        with open(segment.index_path, "wb") as f:
+            f.write(b"".join(index_entries))
+        if is_active:
+            segment.open_for_append()
+        else:
+            segment.map_index()
+
+    def close(self):
+        with self.lock:
+            self.segments[-1].seal(self.fsync)
+
+    def write_records(self, records):
+        # Caller holds self.lock; records are (id, kind, username, message)
+        active = self.segments[-1]
+        encoded = [encode_record(*record) for record in records]
+        total = sum(len(data) for data in encoded)
+        if active.size and active.size + total > self.segment_max_bytes:
+            active.seal(self.fsync)
+            active = Segment(self.directory, max(self.next_id, active.base_id + 1))
+            active.open_for_append()
+            self.segments.append(active)
+        offset = active.size
+        index_entries = []
+        for (message_id, kind, _, _), data in zip(records, encoded):
+            entry = active.record_appended(
+                message_id, kind, offset, len(data), self.index_interval
+            )
+            if entry:
+                index_entries.append(entry)
+            offset += len(data)
+        os.write(active.log_fd, b"".join(encoded))
+        if self.fsync:
+            os.fsync(active.log_fd)
+        if index_entries:
+            active.index_file.write(b"".join(index_entries))
+            active.index_file.flush()
+
+    def append(self, username, message):
+        return self.append_many([(username, message)])[0]
+
+    def append_many(self, messages):
+        """Append (username, message) pairs in one write and return their ids."""
+        with self.lock:
+            records = []
+            for username, message in messages:
+                records.append(
+                    (
+                        self.next_id,
+                        KIND_MESSAGE,
+                        username.encode("utf-8"),
+                        message.encode("utf-8"),
+                    )
+                )
+                self.next_id += 1
+            self.write_records(records)
+        return [record[0] for record in records]
+
+    def delete(self, message_id, requesting_username):
+        """Tombstone a message if it exists and belongs to requesting_username."""
+        with self.lock:
+            record = self.find_record(message_id)
+            if (
+                record is None
+                or bytes(record[0]).decode("utf-8") != requesting_username
+            ):
+                return False
+            self.write_records([(message_id, KIND_TOMBSTONE, b"", b"")])
+            self.deleted_ids.add(message_id)
+        return True
+
+    def delete_many(self, message_ids, requesting_username):
+        """Tombstone the listed messages owned by requesting_username in one write.
+
+        Returns the ids that were deleted.
+        """
+        with self.lock:
+            deleted = []
+            for message_id in message_ids:
+                record = self.find_record(message_id)
+                if record and bytes(record[0]).decode("utf-8") == requesting_username:
+                    deleted.append(message_id)
+            if deleted:
+                self.write_records(
+                    [(message_id, KIND_TOMBSTONE, b"", b"") for message_id in deleted]
+                )
+                self.deleted_ids.update(deleted)
+        return deleted
+
+    def delete_user(self, username):
+        """Tombstone every message by username in one write; returns the ids."""
+        encoded_username = username.encode("utf-8")
+        with self.lock:
+            deleted = []
+            for segment in self.segments:
+                if segment.first_id is None:
+                    continue
+                for kind, message_id, record_username, _, _, _ in iterate_records(
+                    segment.view(segment.size)
+                ):
+                    if (
+                        kind == KIND_MESSAGE
+                        and record_username == encoded_username
+                        and message_id not in self.deleted_ids
+                    ):
+                        deleted.append(message_id)
+            if deleted:
+                self.write_records(
+                    [(message_id, KIND_TOMBSTONE, b"", b"") for message_id in deleted]
+                )
+                self.deleted_ids.update(deleted)
+        return deleted
+
+    def find_record(self, message_id):
+        if message_id in self.deleted_ids:
+            return None
+        for segment in reversed(self.segments):
+            if segment.first_id is None or segment.first_id > message_id:
+                continue
+            if segment.last_id < message_id:
+                return None
+            view = segment.view(segment.size)
+            offset = segment.offset_for(message_id - 1)
+            for kind, record_id, username, message, _, _ in iterate_records(
+                view, offset
+            ):
+                if kind == KIND_MESSAGE and record_id >= message_id:
+                    if record_id == message_id:
+                        return username, message
+                    return None
+            return None
+        return None
+
+    def iter_since(self, last_id):
+        """Yield (id, username view, message view) for live messages after last_id.
+
+        The views are zero-copy slices of the memory-mapped segment files.
+        """
+        with self.lock:
+            segments = [(segment, segment.size) for segment in self.segments]
+        deleted_ids = self.deleted_ids
+        for segment, size in segments:
+            if segment.last_id is None or segment.last_id <= last_id:
+                continue
+            view = segment.view(size)
+            for kind, message_id, username, message, _, _ in iterate_records(
+                view, segment.offset_for(last_id)
+            ):
+                if (
+                    kind == KIND_MESSAGE
+                    and message_id > last_id
+                    and message_id not in deleted_ids
+                ):
+                    yield message_id, username, message
+
+    def read_since(self, last_id, limit=None):
+        messages = []
+        for message_id, username, message in self.iter_since(last_id):
+            messages.append(
+                {
+                    "id": message_id,
+                    "username": str(username, "utf-8"),
+                    "message": str(message, "utf-8"),
+                }
+            )
+            if limit is not None and len(messages) >= limit:
+                break
+        return messages
+
+    def compact(self):
+        """Rewrite sealed segments without deleted messages and tombstones."""
+        with self.compaction_lock:
+            with self.lock:
+                sealed = self.segments[:-1]
+                deleted_ids = set(self.deleted_ids)
+            # Ascending order matters: a tombstone may only be dropped once the
+            # segment holding its message has already been rewritten
+            for position, segment in enumerate(sealed):
+                dropped = {
+                    message_id
+                    for message_id in deleted_ids
+                    if segment.first_id is not None
+                    and segment.first_id <= message_id <= segment.last_id
+                }
+                if not dropped and not segment.has_tombstones:
+                    continue
+                replacement = self.rewrite_segment(segment, dropped)
+                with self.lock:
+                    self.segments[self.segments.index(segment)] = replacement
+                    # Replace rather than mutate so in-flight readers still
+                    # filter with the set they started with
+                    self.deleted_ids = self.deleted_ids - dropped
+                print(
+                    f"Compacted segment {segment.base_id}: "
+                    f"removed {len(dropped)} deleted messages"
+                )
+
+    def rewrite_segment(self, segment, dropped):
+        replacement = Segment(self.directory, segment.base_id)
+        log_tmp = replacement.log_path + ".compact"
+        index_tmp = replacement.index_path + ".compact"
+        index_entries = []
+        chunks = []
+        offset = 0
+        for kind, message_id, _, _, record_offset, length in iterate_records(
+            segment.view(segment.size)
+        ):
+            if kind == KIND_TOMBSTONE or message_id in dropped:
+                continue
+            entry = replacement.record_appended(
+                message_id, kind, offset, length, self.index_interval
+            )
+            if entry:
+                index_entries.append(entry)
+            chunks.append(segment.mapped[record_offset : record_offset + length])
+            offset += length
+        with open(log_tmp, "wb") as f:
+            f.write(b"".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(index_tmp, "wb") as f:
+            f.write(b"".join(index_entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_tmp, replacement.index_path)
+        os.replace(log_tmp, replacement.log_path)
+        replacement.index = array.array("q")
+        replacement.map_index()
+        return replacement
+
+    def start_compaction(self, interval=DEFAULT_COMPACTION_INTERVAL):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Error compacting segment log: {e}")
+
+        self.compaction_thread = threading.Thread(target=run, daemon=True)
+        self.compaction_thread.start()
@@ -1,44 +1,288 @@
+import collections
+import fcntl
+import html
 import json
+import os
+import queue
 import select
 import socket
 import sqlite3
+import struct
+import sys
+import termios
 import threading
 import time
+import uuid
+
+import metrics
+import tracing
+from archive import MessageArchive
+from segment_log import SegmentLog
 
 # Server configuration
-SERVER_HOST = "hawk.cs.umanitoba.ca"
-SERVER_PORT = 8635
+SERVER_HOST = os.environ.get("CHAT_SERVER_HOST", "hawk.cs.umanitoba.ca")
+SERVER_PORT = int(os.environ.get("CHAT_SERVER_PORT", "8635"))
+DATABASE_PATH = os.environ.get("CHAT_DATABASE_PATH", "chat_database.db")
+# "sqlite" (default) or "segment" for the append-only segment log
+STORAGE_BACKEND = os.environ.get("CHAT_STORAGE_BACKEND", "sqlite")
+SEGMENT_LOG_DIRECTORY = os.environ.get("CHAT_SEGMENT_LOG_DIR", "chat_log")
+SEGMENT_MAX_BYTES = int(os.environ.get("CHAT_SEGMENT_MAX_BYTES", "67108864"))
+COMPACTION_INTERVAL = float(os.environ.get("CHAT_COMPACTION_INTERVAL", "60"))
+# Retention for the live messages table; 0 disables a limit. Off by default
+# because archived messages can no longer be deleted or searched
+ARCHIVE_DIRECTORY = os.environ.get("CHAT_ARCHIVE_DIR", "")
+ARCHIVE_MAX_LIVE_MESSAGES = int(os.environ.get("CHAT_ARCHIVE_MAX_LIVE", "0"))
+ARCHIVE_MAX_AGE_SECONDS = float(os.environ.get("CHAT_ARCHIVE_MAX_AGE", "0"))
+ARCHIVE_INTERVAL = float(os.environ.get("CHAT_ARCHIVE_INTERVAL", "60"))
+ARCHIVE_FILE_MAX_MESSAGES = 50000
+# Messages replayed to a client.py connection that does not send a last seen id;
+# 0 replays the whole history
+REPLAY_TAIL_MESSAGES = int(os.environ.get("CHAT_REPLAY_TAIL", "200"))
+# Newest messages sent in a change feed reset; 0 sends the whole history,
+# archive included
+CHANGE_RESET_TAIL = int(os.environ.get("CHAT_CHANGE_RESET_TAIL", "1000"))
+# Optional first line from client.py: "__Resume__ [last_id]"
+RESUME_COMMAND = "__Resume__"
 CONNECTION_BACKLOG = 5
 MAX_BUFFER_SIZE = 1024
+# Limits for SEND_MESSAGES / DELETE_MESSAGES frames
+MAX_FRAME_BYTES = 4 * 1024 * 1024
+BATCH_MAX_SIZE = 1000
+FRAME_TIMEOUT = 5
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_SNIPPET_TOKENS = 12
+# Placeholders around matches in a snippet until it has been HTML-escaped
+SNIPPET_MATCH_START = "\x02"
+SNIPPET_MATCH_END = "\x03"
+# Page size for USER_MESSAGES
+USER_MESSAGES_DEFAULT_LIMIT = 50
+USER_MESSAGES_MAX_LIMIT = 100
+# SUBSCRIBE streams: idle heartbeat, and how far a subscriber may fall behind
+# (in queued writes) before it is disconnected and has to resubscribe
+SUBSCRIBER_HEARTBEAT_INTERVAL = 15
+SUBSCRIBER_MAX_QUEUE = 10000
+SUBSCRIBER_SEND_TIMEOUT = 30
+# Tombstones kept for the change feed; clients further behind get a reset
+TOMBSTONE_MAX_ROWS = int(os.environ.get("CHAT_TOMBSTONE_MAX_ROWS", "100000"))
+
+# Set once the FTS5 index exists; SQLite builds without FTS5 cannot search
+full_text_search_enabled = False
+
+# Older history moved out of the live table, set up by start_archiver()
+message_archive = None
+
+# Serializes write transactions on the shared SQLite connection
+database_lock = threading.Lock()
+
+# Last change sequence number handed out; guarded by database_lock
+change_seq = 0
+# Queues of SUBSCRIBE connections; guarded by database_lock
+change_subscribers = []
 
 # List to keep track of connected clients
 active_clients = []
+# Clients still being sent their history; fan-out queues in their "pending"
+# list until they move to active_clients. Both guarded by clients_lock.
+replaying_clients = []
 clients_lock = threading.Lock()
 
 
+def connected_client_samples():
+    with clients_lock:
+        return [((), len(active_clients))]
+
+
+def client_queue_depth_samples():
+    # One unlabelled sample: per-client labels would add a time series for
+    # every reconnect, since usernames and ports are chosen by the clients
+    with clients_lock:
+        clients_copy = active_clients.copy()
+    deepest = 0
+    for client in clients_copy:
+        try:
+            # Bytes written to the socket that the peer has not yet acknowledged
+            raw = fcntl.ioctl(
+                client["socket"].fileno(), termios.TIOCOUTQ, struct.pack("i", 0)
+            )
+        except (OSError, ValueError):
+            continue
+        deepest = max(deepest, struct.unpack("i", raw)[0])
+    return [((), deepest)]
+
+
+MESSAGES_STORED = metrics.Counter(
+    "chat_server_messages_stored_total", "Messages written to the database."
+)
+MESSAGES_ARCHIVED = metrics.Counter(
+    "chat_server_messages_archived_total",
+    "Messages moved from the live table into archive files.",
+)
+MESSAGES_FANNED_OUT = metrics.Counter(
+    "chat_server_messages_fanned_out_total",
+    "Message deliveries to connected clients.",
+    ("result",),
+)
+COMMIT_SECONDS = metrics.Histogram(
+    "chat_server_commit_seconds", "Latency of database commits.", ("operation",)
+)
+CONNECTED_CLIENTS = metrics.Gauge(
+    "chat_server_connected_clients",
+    "Interactive clients currently connected.",
+    callback=connected_client_samples,
+)
+CLIENT_QUEUE_DEPTH = metrics.Gauge(
+    "chat_server_client_queue_max_bytes",
+    "Most bytes queued in the kernel send buffer of any connected client.",
+    callback=client_queue_depth_samples,
+)
+CHANGE_SUBSCRIBERS = metrics.Gauge(
+    "chat_server_change_subscribers",
+    "Connections streaming the change feed with SUBSCRIBE.",
+    callback=lambda: [((), len(change_subscribers))],
+)
+
+
 def initialize_database():
-    connection = sqlite3.connect("chat_database.db", check_same_thread=False)
+    if STORAGE_BACKEND == "segment":
+        segment_log = SegmentLog(
+            SEGMENT_LOG_DIRECTORY, segment_max_bytes=SEGMENT_MAX_BYTES
+        )
+        segment_log.start_compaction(COMPACTION_INTERVAL)
+        print(f"Storing messages in segment log at {SEGMENT_LOG_DIRECTORY}")
+        return segment_log
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError(f"Unknown storage backend '{STORAGE_BACKEND}'")
+    connection = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
     cursor = connection.cursor()
     # Create messages table if it doesn't exist
-    cursor.execute(
-        """
+    cursor.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT,
             message TEXT
         )
-    """
+    """)
+    cursor.execute("PRAGMA table_info(messages)")
+    if "created_at" not in [column[1] for column in cursor.fetchall()]:
+        # Rows written before this column existed are treated as old
+        cursor.execute("ALTER TABLE messages ADD COLUMN created_at REAL")
+    # Per-user history and deletes, newest first
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS messages_username ON messages (username, id)"
     )
     connection.commit()
+    initialize_change_feed(connection)
+    initialize_search_index(connection)
     return connection
 
 
+def initialize_change_feed(connection):
+    """Set up the sequence numbers behind GET_CHANGES.
+
+    Every insert gets the next value in messages.seq and every delete adds a
+    row to tombstones with the next value, so the changes after a client's
+    last seen seq are two indexed range scans.
+    """
+    global change_seq
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA table_info(messages)")
+    if "seq" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+        # Ids already increase in insert order, so they make a valid history
+        cursor.execute("UPDATE messages SET seq = id")
+    cursor.executescript("""
+        CREATE INDEX IF NOT EXISTS messages_seq ON messages (seq);
+        CREATE TABLE IF NOT EXISTS tombstones (
+            seq INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS change_feed_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        """)
+    connection.commit()
+    change_seq = max(
+        current_change_seq(connection), read_change_feed_horizon(connection)
+    )
+
+
+def current_change_seq(connection):
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT MAX(IFNULL((SELECT MAX(seq) FROM messages), 0), "
+        "IFNULL((SELECT MAX(seq) FROM tombstones), 0))"
+    )
+    return cursor.fetchone()[0]
+
+
+def read_change_feed_horizon(connection):
+    # Changes at or below the horizon are no longer all recorded
+    cursor = connection.cursor()
+    cursor.execute("SELECT value FROM change_feed_state WHERE name = 'horizon'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def raise_change_feed_horizon(cursor, seq):
+    cursor.execute(
+        "INSERT INTO change_feed_state (name, value) VALUES ('horizon', ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)",
+        (seq,),
+    )
+
+
+def initialize_search_index(connection):
+    global full_text_search_enabled
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )
+    index_exists = cursor.fetchone() is not None
+    try:
+        # External-content index over messages.message, kept in sync by triggers
+        cursor.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message, content='messages', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages
+            BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+                INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+            END;
+        """)
+        if not index_exists:
+            # Index any history written before search was added
+            cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        connection.commit()
+        full_text_search_enabled = True
+    except sqlite3.OperationalError as e:
+        connection.rollback()
+        print(f"Full-text search disabled: {e}")
+
+
 def client_connection_handler(client_socket, client_address, db_connection):
     username = None
     try:
         client_socket.setblocking(False)
         client_socket.sendall(b"Enter your username:\n")
         username = receive_username_line(client_socket)
+        resume_id = None
+        if username is not None and username.split(" ", 1)[0] == RESUME_COMMAND:
+            # Resuming clients get message ids and only the history they missed
+            resume_id = parse_resume_id(username)
+            username = receive_username_line(client_socket)
         if username is None:
             print(
                 f"Client {client_address[0]}:{client_address[1]} disconnected before sending username."
@@ -56,22 +300,38 @@ def client_connection_handler(client_socket, client_address, db_connection):
         )
         message_buffer = b""
 
-        # Add client to active_clients list
+        # Queue fan-out for the client while its history is replayed, so that
+        # nothing stored meanwhile is lost or arrives ahead of older messages
+        client = {
+            "socket": client_socket,
+            "username": username,
+            "address": f"{client_address[0]}:{client_address[1]}",
+            "resume": resume_id is not None,
+            "pending": [],
+        }
         with clients_lock:
-            active_clients.append({"socket": client_socket, "username": username})
+            replaying_clients.append(client)
 
-        # Send all messages to client
-        messages = retrieve_all_messages(db_connection)
-        if messages:
-            for msg in messages:
-                message_line = f"{msg['username']}: {msg['message']}\n"
-                try:
-                    client_socket.sendall(message_line.encode("utf-8"))
-                except (ConnectionResetError, OSError):
-                    print(
-                        f"Client {client_address[0]}:{client_address[1]} disconnected during message sending."
-                    )
-                    return
+        # Replay the history this client has not seen yet
+        if resume_id:
+            messages = get_messages_since_id(db_connection, resume_id)
+        else:
+            messages = retrieve_recent_messages(db_connection, REPLAY_TAIL_MESSAGES)
+        replay = "".join(
+            format_message_line(
+                msg["username"], msg["message"], msg["id"], resume_id is not None
+            )
+            for msg in messages
+        )
+        try:
+            if replay:
+                client_socket.sendall(replay.encode("utf-8"))
+            activate_client(client, messages[-1]["id"] if messages else 0)
+        except (ConnectionResetError, OSError):
+            print(
+                f"Client {client_address[0]}:{client_address[1]} disconnected during message sending."
+            )
+            return
         while True:
             ready = select.select([client_socket], [], [], 0.1)
             if ready[0]:
@@ -86,9 +346,15 @@ def client_connection_handler(client_socket, client_address, db_connection):
                         if message.lower() == "quit":
                             print(f"User '{username}' disconnected.")
                             return
-                        store_message(db_connection, username, message)
+                        message_id = store_message(db_connection, username, message)
+                        if resume_id is not None:
+                            # Acknowledge the id so the sender can resume after it
+                            client_socket.sendall(f"@{message_id}\n".encode("utf-8"))
                         distribute_message(
-                            db_connection, sender_username=username, message=message
+                            db_connection,
+                            sender_username=username,
+                            message=message,
+                            message_id=message_id,
                         )
                 except (ConnectionResetError, OSError):
                     print(
@@ -105,6 +371,11 @@ def client_connection_handler(client_socket, client_address, db_connection):
             active_clients[:] = [
                 client for client in active_clients if client["socket"] != client_socket
             ]
+            replaying_clients[:] = [
+                client
+                for client in replaying_clients
+                if client["socket"] != client_socket
+            ]
         client_socket.close()
         if username and username != "__WebClient__":
             print(f"{username} disconnected")
@@ -124,17 +395,128 @@ def handle_web_client_commands(client_socket, db_connection, client_address):
                 while b"\n" in message_buffer:
                     command_line, message_buffer = message_buffer.split(b"\n", 1)
                     command = command_line.decode("utf-8").strip()
-                    if command.startswith("GET_MESSAGES"):
+                    if command.startswith("TRACE "):
+                        # Continue the web server's trace; the command follows
+                        tracing.start_trace(
+                            "chat_server", "web_command", trace_id=command[6:38]
+                        )
+                        continue
+                    trace = tracing.current_trace()
+                    if trace is not None:
+                        trace.name = command.split(" ", 1)[0]
+                    if command.startswith("SEND_MESSAGES ") or command.startswith(
+                        "DELETE_MESSAGES "
+                    ):
+                        # Batch commands: "<COMMAND> <length>" then a JSON frame
+                        name, _, length_str = command.partition(" ")
+                        try:
+                            frame_length = int(length_str)
+                        except ValueError:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        frame = read_frame(client_socket, message_buffer, frame_length)
+                        if frame is None:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        if name == "SEND_MESSAGES":
+                            reply = handle_send_messages(db_connection, frame)
+                        else:
+                            reply = handle_delete_messages(db_connection, frame)
+                        if reply is None:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                        else:
+                            client_socket.sendall(json.dumps(reply).encode("utf-8"))
+                        return
+                    elif command.startswith("SUBSCRIBE"):
+                        parts = command.split()
+                        # SUBSCRIBE <since> [tail]
+                        if len(parts) not in (2, 3) or not all(
+                            part.isdigit() for part in parts[1:]
+                        ):
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        if isinstance(db_connection, SegmentLog):
+                            client_socket.sendall(b"UNSUPPORTED\n")
+                            return
+                        # The stream outlives any trace the command came with
+                        tracing.finish_trace()
+                        tail = int(parts[2]) if len(parts) == 3 else None
+                        stream_changes(
+                            client_socket, db_connection, int(parts[1]), tail
+                        )
+                        return
+                    elif command.startswith("GET_CHANGES"):
+                        parts = command.split()
+                        # GET_CHANGES <since> [limit]
+                        try:
+                            since = int(parts[1])
+                            limit = int(parts[2]) if len(parts) == 3 else None
+                        except (IndexError, ValueError):
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        if len(parts) > 3:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        if isinstance(db_connection, SegmentLog):
+                            client_socket.sendall(b"UNSUPPORTED\n")
+                            return
+                        if limit is not None and limit <= 0:
+                            limit = None
+                        changes = get_changes_since(db_connection, since, limit)
+                        with tracing.span("json_encode"):
+                            payload = json.dumps(changes).encode("utf-8")
+                        with tracing.span("reply"):
+                            client_socket.sendall(payload)
+                        return
+                    elif command.startswith("USER_MESSAGES "):
                         parts = command.split()
-                        if len(parts) == 2:
-                            _, last_id_str = parts
+                        # USER_MESSAGES <username> <before> <limit>
+                        if len(parts) != 4:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        try:
+                            before = int(parts[2])
+                            limit = int(parts[3])
+                        except ValueError:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        messages = get_user_messages(
+                            db_connection, parts[1], before, limit
+                        )
+                        with tracing.span("json_encode"):
+                            payload = json.dumps(messages).encode("utf-8")
+                        with tracing.span("reply"):
+                            client_socket.sendall(payload)
+                        return
+                    elif command.startswith("DELETE_USER_MESSAGES "):
+                        parts = command.split()
+                        # DELETE_USER_MESSAGES <username>; the web server
+                        # only sends it for requests with the moderator token
+                        if len(parts) != 2:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        deleted_ids = remove_user_messages(db_connection, parts[1])
+                        client_socket.sendall(json.dumps(deleted_ids).encode("utf-8"))
+                        return
+                    elif command.startswith("GET_MESSAGES"):
+                        parts = command.split()
+                        if len(parts) in (2, 3):
+                            # GET_MESSAGES <last_id> [limit]
                             try:
-                                last_id = int(last_id_str)
+                                last_id = int(parts[1])
+                                limit = int(parts[2]) if len(parts) == 3 else None
                             except ValueError:
                                 client_socket.sendall(b"INVALID_COMMAND\n")
                                 return
-                            messages = get_messages_since_id(db_connection, last_id)
-                            client_socket.sendall(json.dumps(messages).encode("utf-8"))
+                            if limit is not None and limit <= 0:
+                                limit = None
+                            messages = get_messages_since_id(
+                                db_connection, last_id, limit
+                            )
+                            with tracing.span("json_encode"):
+                                payload = json.dumps(messages).encode("utf-8")
+                            with tracing.span("reply"):
+                                client_socket.sendall(payload)
                         else:
                             client_socket.sendall(b"INVALID_COMMAND\n")
                         return  # Close connection after handling the command
@@ -161,16 +543,43 @@ def handle_web_client_commands(client_socket, db_connection, client_address):
                         parts = command.split(" ", 2)
                         if len(parts) == 3:
                             _, sender_username, message = parts
-                            store_message(db_connection, sender_username, message)
+                            message_id = store_message(
+                                db_connection, sender_username, message
+                            )
                             distribute_message(
                                 db_connection,
                                 sender_username=sender_username,
                                 message=message,
+                                message_id=message_id,
                             )
                             client_socket.sendall(b"SUCCESS\n")
                         else:
                             client_socket.sendall(b"INVALID_COMMAND\n")
                         return
+                    elif command.startswith("SEARCH"):
+                        parts = command.split(" ", 3)
+                        if len(parts) != 4:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        _, limit_str, offset_str, query = parts
+                        try:
+                            limit = int(limit_str)
+                            offset = int(offset_str)
+                        except ValueError:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                            return
+                        if not full_text_search_enabled:
+                            client_socket.sendall(b"UNSUPPORTED\n")
+                            return
+                        results = search_messages(db_connection, query, limit, offset)
+                        if results is None:
+                            client_socket.sendall(b"INVALID_COMMAND\n")
+                        else:
+                            client_socket.sendall(json.dumps(results).encode("utf-8"))
+                        return
+                    elif command == "METRICS":
+                        client_socket.sendall(metrics.render_metrics().encode("utf-8"))
+                        return
                     else:
                         client_socket.sendall(b"INVALID_COMMAND\n")
                         return
@@ -180,6 +589,73 @@ def handle_web_client_commands(client_socket, db_connection, client_address):
         print(f"Error handling web client {client_address[0]}:{client_address[1]}: {e}")
     finally:
         client_socket.close()
+        tracing.finish_trace()
+
+
+def read_frame(client_socket, message_buffer, frame_length):
+    """Read a frame_length byte payload that follows a command line."""
+    if frame_length < 0 or frame_length > MAX_FRAME_BYTES:
+        return None
+    frame = message_buffer[:frame_length]
+    deadline = time.time() + FRAME_TIMEOUT
+    while len(frame) < frame_length:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        ready = select.select([client_socket], [], [], remaining)
+        if not ready[0]:
+            return None
+        data = client_socket.recv(min(frame_length - len(frame), 65536))
+        if not data:
+            return None
+        frame += data
+    return frame
+
+
+def handle_send_messages(db_connection, frame):
+    # Frame: [{"username": ..., "message": ...}, ...]; reply: assigned ids
+    try:
+        entries = json.loads(frame.decode("utf-8"))
+        messages = [(entry["username"], entry["message"]) for entry in entries]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not messages or len(messages) > BATCH_MAX_SIZE:
+        return None
+    for username, message in messages:
+        if not isinstance(username, str) or not isinstance(message, str):
+            return None
+        if not username or not message or "\n" in message:
+            return None
+    message_ids = store_messages(db_connection, messages)
+    distribute_messages(db_connection, messages, message_ids)
+    return message_ids
+
+
+def handle_delete_messages(db_connection, frame):
+    # Frame: {"username": ..., "ids": [...]}; reply: the ids actually deleted
+    try:
+        request = json.loads(frame.decode("utf-8"))
+        username = request["username"]
+        message_ids = [int(message_id) for message_id in request["ids"]]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(username, str) or len(message_ids) > BATCH_MAX_SIZE:
+        return None
+    return remove_messages(db_connection, message_ids, username)
+
+
+def parse_resume_id(resume_line):
+    parts = resume_line.split()
+    if len(parts) == 2 and parts[1].isdigit():
+        return int(parts[1])
+    return 0
+
+
+def format_message_line(username, message, message_id, with_id):
+    # Resuming clients get "@<id> " in front of each line to track their position
+    if with_id and message_id is not None:
+        return f"@{message_id} {username}: {message}\n"
+    return f"{username}: {message}\n"
 
 
 def receive_username_line(sock):
@@ -201,55 +677,541 @@ def receive_username_line(sock):
 
 
 def store_message(db_connection, username, message):
-    cursor = db_connection.cursor()
-    cursor.execute(
-        "INSERT INTO messages (username, message) VALUES (?, ?)", (username, message)
-    )
-    db_connection.commit()
+    message_id = store_messages(db_connection, [(username, message)])[0]
     print(f"Message from '{username}': {message}")
+    return message_id
+
+
+def store_messages(db_connection, messages):
+    """Store (username, message) pairs in one transaction and return their ids."""
+    if isinstance(db_connection, SegmentLog):
+        append_start = time.perf_counter()
+        message_ids = db_connection.append_many(messages)
+        append_end = time.perf_counter()
+        COMMIT_SECONDS.observe(append_end - append_start, ("insert",))
+        tracing.add_span("segment_append", append_start, append_end)
+        MESSAGES_STORED.inc(amount=len(messages))
+        return message_ids
+    global change_seq
+    created_at = time.time()
+    with database_lock:
+        cursor = db_connection.cursor()
+        message_ids = []
+        events = []
+        with tracing.span("sqlite_insert"):
+            for username, message in messages:
+                change_seq += 1
+                cursor.execute(
+                    "INSERT INTO messages (username, message, created_at, seq) "
+                    "VALUES (?, ?, ?, ?)",
+                    (username, message, created_at, change_seq),
+                )
+                message_ids.append(cursor.lastrowid)
+                events.append(
+                    {
+                        "seq": change_seq,
+                        "id": cursor.lastrowid,
+                        "username": username,
+                        "message": message,
+                    }
+                )
+        commit_start = time.perf_counter()
+        db_connection.commit()
+        commit_end = time.perf_counter()
+        publish_changes(events)
+    COMMIT_SECONDS.observe(commit_end - commit_start, ("insert",))
+    tracing.add_span("sqlite_commit", commit_start, commit_end)
+    MESSAGES_STORED.inc(amount=len(messages))
+    return message_ids
 
 
 def remove_message(db_connection, message_id, requesting_username):
-    cursor = db_connection.cursor()
-    cursor.execute("SELECT username FROM messages WHERE id = ?", (message_id,))
-    result = cursor.fetchone()
-    if result and result[0] == requesting_username:
-        cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+    if isinstance(db_connection, SegmentLog):
+        with tracing.span("segment_tombstone"):
+            removed = db_connection.delete(message_id, requesting_username)
+        if removed:
+            print(f"Message {message_id} deleted by '{requesting_username}'")
+        return removed
+    with database_lock:
+        cursor = db_connection.cursor()
+        # Ownership is checked by the DELETE itself, so another process writing
+        # to the database cannot slip in between a check and the delete
+        cursor.execute(
+            "DELETE FROM messages WHERE id = ? AND username = ?",
+            (message_id, requesting_username),
+        )
+        if cursor.rowcount == 0:
+            db_connection.rollback()
+            return False
+        events = record_tombstones(cursor, [message_id])
+        commit_start = time.perf_counter()
         db_connection.commit()
-        print(f"Message {message_id} deleted by '{requesting_username}'")
-        return True
+        commit_end = time.perf_counter()
+        publish_changes(events)
+    COMMIT_SECONDS.observe(commit_end - commit_start, ("delete",))
+    tracing.add_span("sqlite_commit", commit_start, commit_end)
+    print(f"Message {message_id} deleted by '{requesting_username}'")
+    return True
+
+
+def remove_messages(db_connection, message_ids, requesting_username):
+    """Delete the listed messages owned by requesting_username in one transaction.
+
+    Returns the ids that were actually deleted.
+    """
+    message_ids = sorted(set(message_ids))
+    if not message_ids:
+        return []
+    if isinstance(db_connection, SegmentLog):
+        with tracing.span("segment_tombstone"):
+            deleted_ids = db_connection.delete_many(message_ids, requesting_username)
     else:
-        return False
+        placeholders = ",".join("?" * len(message_ids))
+        with database_lock:
+            cursor = db_connection.cursor()
+            cursor.execute(
+                f"DELETE FROM messages WHERE username = ? AND id IN ({placeholders}) "
+                "RETURNING id",
+                [requesting_username] + message_ids,
+            )
+            deleted_ids = sorted(row[0] for row in cursor.fetchall())
+            if not deleted_ids:
+                db_connection.rollback()
+                return []
+            events = record_tombstones(cursor, deleted_ids)
+            commit_start = time.perf_counter()
+            db_connection.commit()
+            commit_end = time.perf_counter()
+            publish_changes(events)
+        COMMIT_SECONDS.observe(commit_end - commit_start, ("delete",))
+        tracing.add_span("sqlite_commit", commit_start, commit_end)
+    print(f"{len(deleted_ids)} messages deleted by '{requesting_username}'")
+    return deleted_ids
+
+
+def remove_user_messages(db_connection, username):
+    """Delete every live message by username in one transaction; returns the ids."""
+    if isinstance(db_connection, SegmentLog):
+        with tracing.span("segment_tombstone"):
+            deleted_ids = db_connection.delete_user(username)
+    else:
+        with database_lock:
+            cursor = db_connection.cursor()
+            cursor.execute(
+                "DELETE FROM messages WHERE username = ? RETURNING id", (username,)
+            )
+            deleted_ids = sorted(row[0] for row in cursor.fetchall())
+            if not deleted_ids:
+                db_connection.rollback()
+                return []
+            events = record_tombstones(cursor, deleted_ids)
+            commit_start = time.perf_counter()
+            db_connection.commit()
+            commit_end = time.perf_counter()
+            publish_changes(events)
+        COMMIT_SECONDS.observe(commit_end - commit_start, ("delete",))
+        tracing.add_span("sqlite_commit", commit_start, commit_end)
+    if deleted_ids:
+        print(f"All {len(deleted_ids)} messages by '{username}' deleted")
+    return deleted_ids
+
+
+def record_tombstones(cursor, message_ids):
+    # Caller holds database_lock and commits; returns the change events
+    global change_seq
+    rows = []
+    for message_id in message_ids:
+        change_seq += 1
+        rows.append((change_seq, message_id))
+    cursor.executemany("INSERT INTO tombstones (seq, message_id) VALUES (?, ?)", rows)
+    return [{"seq": seq, "deleted": message_id} for seq, message_id in rows]
+
+
+def publish_changes(events):
+    # Caller holds database_lock, so every subscriber gets events in seq order
+    if not change_subscribers or not events:
+        return
+    lines = "".join(json.dumps(event) + "\n" for event in events).encode("utf-8")
+    for subscriber in list(change_subscribers):
+        if subscriber["queue"].qsize() >= SUBSCRIBER_MAX_QUEUE:
+            # Too far behind; it will resubscribe from its last seq
+            subscriber["dropped"] = True
+            change_subscribers.remove(subscriber)
+        else:
+            subscriber["queue"].put(lines)
+
+
+def stream_changes(client_socket, db_connection, since, tail=None):
+    """Serve SUBSCRIBE: the changes after since, then every change as it commits.
+
+    The first line is a GET_CHANGES result; after it each line is one change,
+    {"seq", "id", "username", "message"} or {"seq", "deleted"}, and an empty
+    line is sent when nothing has happened for a while. tail, if given,
+    replaces CHANGE_RESET_TAIL for a reset (see get_changes_since).
+    """
+    subscriber = {"queue": queue.SimpleQueue(), "dropped": False}
+    # Registered before the snapshot is read so no change falls in between;
+    # changes covered by both are repeated and the subscriber skips them by seq
+    with database_lock:
+        change_subscribers.append(subscriber)
+    try:
+        client_socket.settimeout(SUBSCRIBER_SEND_TIMEOUT)
+        snapshot = get_changes_since(db_connection, since, tail=tail)
+        client_socket.sendall((json.dumps(snapshot) + "\n").encode("utf-8"))
+        while not subscriber["dropped"]:
+            try:
+                chunks = [
+                    subscriber["queue"].get(timeout=SUBSCRIBER_HEARTBEAT_INTERVAL)
+                ]
+            except queue.Empty:
+                chunks = [b"\n"]
+            while True:
+                try:
+                    chunks.append(subscriber["queue"].get_nowait())
+                except queue.Empty:
+                    break
+            client_socket.sendall(b"".join(chunks))
+    except OSError as e:
+        print(f"Change subscriber disconnected: {e}")
+    finally:
+        with database_lock:
+            if subscriber in change_subscribers:
+                change_subscribers.remove(subscriber)
+
+
+def activate_client(client, replayed_id):
+    """Send what was fanned out during the replay, then move client to active_clients.
+
+    Messages with ids up to replayed_id were in the replay and are skipped.
+    """
+    column = 3 if client["resume"] else 2
+    while True:
+        with clients_lock:
+            pending = client["pending"]
+            if not pending:
+                replaying_clients.remove(client)
+                active_clients.append(client)
+                return
+            client["pending"] = []
+        payload = b"".join(
+            entry[column]
+            for entry in pending
+            if entry[1] != client["username"]
+            and (entry[0] is None or entry[0] > replayed_id)
+        )
+        if payload:
+            client["socket"].sendall(payload)
+            MESSAGES_FANNED_OUT.inc(("delivered",), payload.count(b"\n"))
 
 
-def distribute_message(db_connection, sender_username, message):
+def distribute_message(db_connection, sender_username, message, message_id=None):
+    fanout_start = time.perf_counter()
+    plain_line = format_message_line(sender_username, message, None, False).encode(
+        "utf-8"
+    )
+    id_line = format_message_line(sender_username, message, message_id, True).encode(
+        "utf-8"
+    )
     with clients_lock:
         clients_copy = active_clients.copy()
+        for client in replaying_clients:
+            client["pending"].append((message_id, sender_username, plain_line, id_line))
     for client in clients_copy:
         if client["username"] != sender_username:
             try:
-                message_line = f"{sender_username}: {message}\n"
-                client["socket"].sendall(message_line.encode("utf-8"))
+                client["socket"].sendall(id_line if client["resume"] else plain_line)
+                MESSAGES_FANNED_OUT.inc(("delivered",))
             except Exception as e:
+                MESSAGES_FANNED_OUT.inc(("failed",))
                 print(f"Error sending message to {client['username']}: {e}")
                 with clients_lock:
                     if client in active_clients:
                         client["socket"].close()
                         active_clients.remove(client)
+    tracing.add_span("fanout", fanout_start, time.perf_counter())
+
+
+def distribute_messages(db_connection, messages, message_ids):
+    """Fan out a batch of (username, message) pairs with one send per client."""
+    fanout_start = time.perf_counter()
+    # (id, sender, plain line, line with id) for each message
+    lines = [
+        (
+            message_id,
+            username,
+            format_message_line(username, message, None, False).encode("utf-8"),
+            format_message_line(username, message, message_id, True).encode("utf-8"),
+        )
+        for (username, message), message_id in zip(messages, message_ids)
+    ]
+    with clients_lock:
+        clients_copy = active_clients.copy()
+        for client in replaying_clients:
+            client["pending"].extend(lines)
+    for client in clients_copy:
+        column = 3 if client["resume"] else 2
+        payload = b"".join(
+            line[column] for line in lines if line[1] != client["username"]
+        )
+        if not payload:
+            continue
+        try:
+            client["socket"].sendall(payload)
+            MESSAGES_FANNED_OUT.inc(("delivered",), payload.count(b"\n"))
+        except Exception as e:
+            MESSAGES_FANNED_OUT.inc(("failed",), payload.count(b"\n"))
+            print(f"Error sending messages to {client['username']}: {e}")
+            with clients_lock:
+                if client in active_clients:
+                    client["socket"].close()
+                    active_clients.remove(client)
+    tracing.add_span("fanout", fanout_start, time.perf_counter())
+
+
+def get_messages_since_id(db_connection, last_id, limit=None):
+    if isinstance(db_connection, SegmentLog):
+        with tracing.span("segment_read"):
+            return db_connection.read_since(last_id, limit)
+    if message_archive is None:
+        return query_live_messages(db_connection, last_id, limit)
+    while True:
+        archived_max_id = message_archive.max_id
+        messages = []
+        if last_id < archived_max_id:
+            with tracing.span("archive_read"):
+                messages = message_archive.read_since(last_id, limit, archived_max_id)
+            if limit is not None and len(messages) >= limit:
+                return messages
+        # Rows at or below the archive's last id may linger in the live table
+        # if the server stopped between archiving and deleting them
+        remaining = None if limit is None else limit - len(messages)
+        live = query_live_messages(
+            db_connection, max(last_id, archived_max_id), remaining
+        )
+        # If rows were archived meanwhile they may have left the live table
+        # before the query saw them, so read again
+        if message_archive.max_id == archived_max_id:
+            return messages + live
 
 
-def get_messages_since_id(db_connection, last_id):
+def query_live_messages(db_connection, last_id, limit=None):
+    cursor = db_connection.cursor()
+    with tracing.span("sqlite_query"):
+        if limit is None:
+            cursor.execute(
+                "SELECT id, username, message FROM messages WHERE id > ? ORDER BY id",
+                (last_id,),
+            )
+        else:
+            cursor.execute(
+                "SELECT id, username, message FROM messages WHERE id > ? "
+                "ORDER BY id LIMIT ?",
+                (last_id, limit),
+            )
+        rows = cursor.fetchall()
+    messages = [{"id": row[0], "username": row[1], "message": row[2]} for row in rows]
+    return messages
+
+
+def get_changes_since(db_connection, since, limit=None, tail=None):
+    """Return the messages added and ids deleted after change seq since.
+
+    The result's "seq" is the cursor to pass next time. A full page of
+    messages ends the delta early so that repeated calls catch up. When the
+    tombstones needed to bring since up to date have been pruned or the
+    messages archived, "reset" is true and "messages" holds the newest tail
+    live messages instead (CHANGE_RESET_TAIL by default), with "floor" the
+    highest id that older messages may have. A tail of 0 resets to the whole
+    history, archive included, with a floor of 0.
+    """
+    cursor = db_connection.cursor()
+    with database_lock:
+        current_seq = change_seq
+        horizon = read_change_feed_horizon(db_connection)
+    if since <= 0 or since < horizon or since > current_seq:
+        # A new client, one too far behind, or a cursor from a replaced database
+        if tail is None:
+            tail = CHANGE_RESET_TAIL
+        if tail > 0:
+            return get_recent_changes(db_connection, current_seq, tail)
+        with tracing.span("sqlite_query"):
+            messages = get_messages_since_id(db_connection, 0)
+        return {
+            "seq": current_seq,
+            "reset": True,
+            "messages": messages,
+            "deleted": [],
+            "floor": 0,
+        }
+    with tracing.span("sqlite_query"):
+        if limit is None:
+            cursor.execute(
+                "SELECT seq, id, username, message FROM messages "
+                "WHERE seq > ? AND seq <= ? ORDER BY seq",
+                (since, current_seq),
+            )
+        else:
+            cursor.execute(
+                "SELECT seq, id, username, message FROM messages "
+                "WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (since, current_seq, limit),
+            )
+        rows = cursor.fetchall()
+        if limit is not None and len(rows) == limit:
+            current_seq = rows[-1][0]
+        cursor.execute(
+            "SELECT message_id FROM tombstones WHERE seq > ? AND seq <= ? ORDER BY seq",
+            (since, current_seq),
+        )
+        deleted = [row[0] for row in cursor.fetchall()]
+    return {
+        "seq": current_seq,
+        "reset": False,
+        "messages": [
+            {"id": row[1], "username": row[2], "message": row[3]} for row in rows
+        ],
+        "deleted": deleted,
+    }
+
+
+def get_recent_changes(db_connection, current_seq, tail):
+    # A reset holding only the newest tail messages
+    with tracing.span("sqlite_query"):
+        messages = retrieve_recent_messages(db_connection, tail)
+    if len(messages) == tail:
+        floor = messages[0]["id"] - 1
+    elif message_archive is not None:
+        # The live table is short but older messages sit in the archive
+        floor = messages[0]["id"] - 1 if messages else message_archive.max_id
+    else:
+        floor = 0
+    return {
+        "seq": current_seq,
+        "reset": True,
+        "messages": messages,
+        "deleted": [],
+        "floor": floor,
+    }
+
+
+def highlight_snippet(snippet):
+    # FTS5 marks matches with the control characters passed to snippet();
+    # escape the message text first, then turn those marks into <mark> tags
+    return (
+        html.escape(snippet, quote=False)
+        .replace(SNIPPET_MATCH_START, "<mark>")
+        .replace(SNIPPET_MATCH_END, "</mark>")
+    )
+
+
+def build_search_query(text):
+    # Quote every term so user input can't use FTS5 operators or break syntax
+    terms = text.split()
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def search_messages(db_connection, text, limit, offset):
+    """Return ranked matches for text, or None if the query is unusable."""
+    match_query = build_search_query(text)
+    if not match_query or offset < 0:
+        return None
+    if limit <= 0:
+        limit = SEARCH_DEFAULT_LIMIT
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    cursor = db_connection.cursor()
+    with tracing.span("fts_query"):
+        cursor.execute(
+            """
+            SELECT m.id, m.username, m.message,
+                   snippet(messages_fts, 0, ?, ?, '...', ?)
+            FROM messages_fts
+            JOIN messages AS m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+            """,
+            (
+                SNIPPET_MATCH_START,
+                SNIPPET_MATCH_END,
+                SEARCH_SNIPPET_TOKENS,
+                match_query,
+                limit,
+                offset,
+            ),
+        )
+        rows = cursor.fetchall()
+    return [
+        {
+            "id": row[0],
+            "username": row[1],
+            "message": row[2],
+            "snippet": highlight_snippet(row[3]),
+        }
+        for row in rows
+    ]
+
+
+def get_user_messages(db_connection, username, before, limit):
+    """Return up to limit live messages by username with ids below before.
+
+    Newest first; before <= 0 starts from the newest message.
+    """
+    if limit <= 0:
+        limit = USER_MESSAGES_DEFAULT_LIMIT
+    limit = min(limit, USER_MESSAGES_MAX_LIMIT)
+    if isinstance(db_connection, SegmentLog):
+        # The segment log has no username index, so this scans the whole log
+        encoded_username = username.encode("utf-8")
+        matches = collections.deque(maxlen=limit)
+        with tracing.span("segment_read"):
+            for message_id, record_username, message in db_connection.iter_since(0):
+                if before > 0 and message_id >= before:
+                    break
+                if record_username == encoded_username:
+                    matches.append((message_id, str(message, "utf-8")))
+        return [
+            {"id": message_id, "username": username, "message": message}
+            for message_id, message in reversed(matches)
+        ]
+    cursor = db_connection.cursor()
+    with tracing.span("sqlite_query"):
+        if before > 0:
+            cursor.execute(
+                "SELECT id, message FROM messages WHERE username = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?",
+                (username, before, limit),
+            )
+        else:
+            cursor.execute(
+                "SELECT id, message FROM messages WHERE username = ? "
+                "ORDER BY id DESC LIMIT ?",
+                (username, limit),
+            )
+        rows = cursor.fetchall()
+    return [{"id": row[0], "username": username, "message": row[1]} for row in rows]
+
+
+def retrieve_recent_messages(db_connection, count):
+    """Return the newest count live messages, oldest first; 0 returns them all."""
+    if count <= 0:
+        return retrieve_all_messages(db_connection)
+    if isinstance(db_connection, SegmentLog):
+        # Ids are dense in the log, so this skips straight to the tail
+        return db_connection.read_since(max(db_connection.next_id - 1 - count, 0))
     cursor = db_connection.cursor()
     cursor.execute(
-        "SELECT id, username, message FROM messages WHERE id > ? ORDER BY id",
-        (last_id,),
+        "SELECT id, username, message FROM "
+        "(SELECT id, username, message FROM messages ORDER BY id DESC LIMIT ?) "
+        "ORDER BY id",
+        (count,),
     )
     rows = cursor.fetchall()
-    messages = [{"id": row[0], "username": row[1], "message": row[2]} for row in rows]
-    return messages
+    return [{"id": row[0], "username": row[1], "message": row[2]} for row in rows]
 
 
 def retrieve_all_messages(db_connection):
+    if isinstance(db_connection, SegmentLog):
+        return db_connection.read_since(0)
     cursor = db_connection.cursor()
     cursor.execute("SELECT id, username, message FROM messages ORDER BY id")
     rows = cursor.fetchall()
@@ -257,13 +1219,161 @@ def retrieve_all_messages(db_connection):
     return messages
 
 
+def archive_old_messages(db_connection):
+    """Move messages past the retention limits into compressed archive files."""
+    cursor = db_connection.cursor()
+    with database_lock:
+        prune_tombstones(cursor)
+        if message_archive is not None:
+            # Finish any deletion interrupted after the archive file was written
+            delete_archived_rows(cursor, message_archive.max_id)
+        db_connection.commit()
+    if message_archive is None:
+        return
+
+    cutoff_id = 0
+    if ARCHIVE_MAX_LIVE_MESSAGES > 0:
+        cursor.execute(
+            "SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (ARCHIVE_MAX_LIVE_MESSAGES,),
+        )
+        row = cursor.fetchone()
+        if row:
+            cutoff_id = row[0]
+    if ARCHIVE_MAX_AGE_SECONDS > 0:
+        cursor.execute(
+            "SELECT MAX(id) FROM messages WHERE created_at IS NULL OR created_at < ?",
+            (time.time() - ARCHIVE_MAX_AGE_SECONDS,),
+        )
+        row = cursor.fetchone()
+        if row and row[0]:
+            cutoff_id = max(cutoff_id, row[0])
+
+    while True:
+        cursor.execute(
+            "SELECT id, username, message FROM messages WHERE id <= ? "
+            "ORDER BY id LIMIT ?",
+            (cutoff_id, ARCHIVE_FILE_MAX_MESSAGES),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        archive_base = message_archive.write(rows)
+        with database_lock:
+            # Ids are never reused, so fewer rows in the range means a message
+            # was deleted while the file was written; archive the range again
+            cursor.execute(
+                "SELECT COUNT(*) FROM messages WHERE id >= ? AND id <= ?",
+                (rows[0][0], rows[-1][0]),
+            )
+            if cursor.fetchone()[0] != len(rows):
+                message_archive.discard(archive_base)
+                continue
+            message_archive.publish(archive_base)
+            delete_archived_rows(cursor, rows[-1][0])
+            db_connection.commit()
+        MESSAGES_ARCHIVED.inc(amount=len(rows))
+        print(f"Archived messages {rows[0][0]} to {rows[-1][0]}")
+
+
+def delete_archived_rows(cursor, archived_max_id):
+    # Caller holds database_lock. Archiving is not a deletion, so instead of
+    # tombstones the change feed sends clients that missed these rows a reset
+    cursor.execute("SELECT MAX(seq) FROM messages WHERE id <= ?", (archived_max_id,))
+    row = cursor.fetchone()
+    if row[0] is None:
+        return
+    raise_change_feed_horizon(cursor, row[0])
+    cursor.execute("DELETE FROM messages WHERE id <= ?", (archived_max_id,))
+
+
+def prune_tombstones(cursor):
+    # Caller holds database_lock
+    cursor.execute(
+        "SELECT seq FROM tombstones ORDER BY seq DESC LIMIT 1 OFFSET ?",
+        (TOMBSTONE_MAX_ROWS,),
+    )
+    row = cursor.fetchone()
+    if row:
+        raise_change_feed_horizon(cursor, row[0])
+        cursor.execute("DELETE FROM tombstones WHERE seq <= ?", (row[0],))
+
+
+def start_archiver(db_connection):
+    """Archive old messages and prune tombstones every ARCHIVE_INTERVAL."""
+    global message_archive
+    if isinstance(db_connection, SegmentLog):
+        # The segment log keeps history in its own files
+        return
+    if ARCHIVE_MAX_LIVE_MESSAGES > 0 or ARCHIVE_MAX_AGE_SECONDS > 0:
+        message_archive = open_message_archive(db_connection)
+
+    def run():
+        while True:
+            try:
+                archive_old_messages(db_connection)
+            except Exception as e:
+                print(f"Error archiving messages: {e}")
+            time.sleep(ARCHIVE_INTERVAL)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def open_message_archive(db_connection):
+    # The archive replaces live rows, so it must never be opened against a
+    # database other than the one whose messages it holds
+    directory = ARCHIVE_DIRECTORY or DATABASE_PATH + ".archive"
+    archive = MessageArchive(directory)
+    database_id = read_database_id(db_connection)
+    if archive.owner is None:
+        # Archives from before owners were recorded are only adopted by a
+        # database whose ids already continue past them
+        cursor = db_connection.cursor()
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+        row = cursor.fetchone()
+        if archive.max_id > (row[0] if row else 0):
+            print(f"Archive {directory} does not belong to {DATABASE_PATH}")
+            sys.exit(1)
+        archive.set_owner(database_id)
+    elif archive.owner != database_id:
+        print(f"Archive {directory} belongs to another database than {DATABASE_PATH}")
+        sys.exit(1)
+    print(f"Archiving old messages to {directory}")
+    return archive
+
+
+def read_database_id(connection):
+    """Return the random id that tells this database apart from others."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS database_info "
+        "(name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO database_info (name, value) VALUES ('id', ?)",
+        (uuid.uuid4().hex,),
+    )
+    connection.commit()
+    cursor.execute("SELECT value FROM database_info WHERE name = 'id'")
+    return cursor.fetchone()[0]
+
+
 def main():
+    server_port = SERVER_PORT
+    if len(sys.argv) >= 2:
+        try:
+            server_port = int(sys.argv[1])
+        except ValueError:
+            print(f"Invalid port number. Using default port {SERVER_PORT}.")
+
     db_connection = initialize_database()
+    start_archiver(db_connection)
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((SERVER_HOST, SERVER_PORT))
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((SERVER_HOST, server_port))
     server_socket.listen(CONNECTION_BACKLOG)
-    print(f"Chat server listening on {SERVER_HOST}:{SERVER_PORT}")
+    print(f"Chat server listening on {SERVER_HOST}:{server_port}")
 
     try:
         while True:
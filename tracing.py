@@ -0,0 +1,206 @@
+import contextlib
+import cProfile
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+# Finished traces are appended here as JSON lines; tracing is off when unset
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+# Fraction of traced requests to run under cProfile, e.g. "0.01"
+TRACE_PROFILE_RATE = float(os.environ.get("TRACE_PROFILE_RATE", "0"))
+# Writing a new rate into this file changes it without a restart
+TRACE_PROFILE_CONTROL_FILE = os.environ.get(
+    "TRACE_PROFILE_CONTROL_FILE", "trace_profile_rate"
+)
+TRACE_PROFILE_DIR = os.environ.get("TRACE_PROFILE_DIR", "profiles")
+CONTROL_FILE_CHECK_INTERVAL = 1.0
+
+current = threading.local()
+trace_queue = queue.SimpleQueue()
+writer_lock = threading.Lock()
+writer_thread = None
+profiler_lock = threading.Lock()
+profile_control = {"rate": TRACE_PROFILE_RATE, "checked_at": 0.0, "mtime": None}
+
+
+class Trace:
+    __slots__ = (
+        "trace_id",
+        "service",
+        "name",
+        "started_at",
+        "start",
+        "spans",
+        "attributes",
+        "profiler",
+    )
+
+    def __init__(self, trace_id, service, name, start):
+        self.trace_id = trace_id
+        self.service = service
+        self.name = name
+        self.started_at = time.time()
+        self.start = start
+        self.spans = []
+        self.attributes = {}
+        self.profiler = None
+
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+
+def start_trace(service, name, trace_id=None, start=None):
+    """Begin a trace for the current thread and return it."""
+    if start is None:
+        start = time.perf_counter()
+    trace = Trace(trace_id or new_trace_id(), service, name, start)
+    current.trace = trace
+    if should_profile() and profiler_lock.acquire(blocking=False):
+        # Only one request is profiled at a time to bound the overhead
+        trace.profiler = cProfile.Profile()
+        trace.profiler.enable()
+    return trace
+
+
+def current_trace():
+    return getattr(current, "trace", None)
+
+
+def attach_trace(trace):
+    """Make trace current in this thread too, for work handed off by a request."""
+    current.trace = trace
+
+
+def current_trace_id():
+    trace = getattr(current, "trace", None)
+    return trace.trace_id if trace is not None else None
+
+
+def add_span(name, start, end):
+    """Record an interval measured with time.perf_counter() on the current trace."""
+    trace = getattr(current, "trace", None)
+    if trace is not None:
+        trace.spans.append((name, start, end))
+
+
+@contextlib.contextmanager
+def span(name):
+    trace = getattr(current, "trace", None)
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, start, time.perf_counter()))
+
+
+def finish_trace(**attributes):
+    """End the current thread's trace and hand it to the file sink."""
+    trace = getattr(current, "trace", None)
+    if trace is None:
+        return
+    current.trace = None
+    end = time.perf_counter()
+    profile_path = None
+    if trace.profiler is not None:
+        trace.profiler.disable()
+        profiler_lock.release()
+        profile_path = save_profile(trace)
+    if not TRACE_FILE:
+        return
+    trace.attributes.update(attributes)
+    record = {
+        "trace_id": trace.trace_id,
+        "service": trace.service,
+        "name": trace.name,
+        "started_at": round(trace.started_at, 6),
+        "duration_ms": round((end - trace.start) * 1000, 3),
+        "spans": [
+            {
+                "name": name,
+                "offset_ms": round((start - trace.start) * 1000, 3),
+                "duration_ms": round((stop - start) * 1000, 3),
+            }
+            for name, start, stop in trace.spans
+        ],
+    }
+    if trace.attributes:
+        record["attributes"] = trace.attributes
+    if profile_path:
+        record["profile"] = profile_path
+    ensure_writer()
+    trace_queue.put(record)
+
+
+def save_profile(trace):
+    try:
+        os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_PROFILE_DIR, f"{trace.service}-{trace.trace_id}.prof")
+        trace.profiler.dump_stats(path)
+        return path
+    except OSError as e:
+        print(f"Error saving profile for trace {trace.trace_id}: {e}")
+        return None
+
+
+def should_profile():
+    now = time.monotonic()
+    if now - profile_control["checked_at"] >= CONTROL_FILE_CHECK_INTERVAL:
+        profile_control["checked_at"] = now
+        reload_profile_rate()
+    rate = profile_control["rate"]
+    return rate > 0 and random.random() < rate
+
+
+def reload_profile_rate():
+    try:
+        mtime = os.stat(TRACE_PROFILE_CONTROL_FILE).st_mtime
+    except OSError:
+        # Removing the control file falls back to the configured rate
+        profile_control["mtime"] = None
+        profile_control["rate"] = TRACE_PROFILE_RATE
+        return
+    if mtime == profile_control["mtime"]:
+        return
+    profile_control["mtime"] = mtime
+    try:
+        with open(TRACE_PROFILE_CONTROL_FILE) as f:
+            rate = float(f.read().strip() or 0)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring invalid profile rate in {TRACE_PROFILE_CONTROL_FILE}: {e}")
+        return
+    profile_control["rate"] = min(max(rate, 0.0), 1.0)
+    print(f"Profiling {profile_control['rate']:.2%} of traced requests")
+
+
+def ensure_writer():
+    global writer_thread
+    if writer_thread is not None:
+        return
+    with writer_lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=write_traces, daemon=True)
+            writer_thread.start()
+
+
+def write_traces():
+    while True:
+        records = [trace_queue.get()]
+        # Drain whatever else has queued up so bursts become a single write
+        while True:
+            try:
+                records.append(trace_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        try:
+            with open(TRACE_FILE, "a") as f:
+                f.write(lines)
+        except OSError as e:
+            print(f"Error writing traces to {TRACE_FILE}: {e}")
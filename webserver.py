@@ -1,57 +1,421 @@
+import hmac
 import json
 import os
+import queue
+import random
 import re
 import select
+import shutil
+import signal
 import socket
+import sqlite3
+import subprocess
 import sys
+import tempfile
 import threading
 import time
+import urllib.parse
 import uuid
 
+import metrics
+import tracing
+from replica import MessageReplica
+
 # Web server configuration
-WEB_SERVER_HOST = ""
-WEB_SERVER_PORT = 8636
+WEB_SERVER_HOST = os.environ.get("WEB_SERVER_HOST", "")
+WEB_SERVER_PORT = int(os.environ.get("WEB_SERVER_PORT", "8636"))
+# More than one worker runs a supervisor that prefork-starts worker processes
+WEB_SERVER_WORKERS = int(os.environ.get("WEB_SERVER_WORKERS", "1"))
+# Have each worker bind its own SO_REUSEPORT socket instead of sharing one
+WEB_SERVER_REUSEPORT = os.environ.get("WEB_SERVER_REUSEPORT", "0") == "1"
+# How long a stopping worker waits for requests in progress
+WORKER_DRAIN_SECONDS = float(os.environ.get("WEB_WORKER_DRAIN_SECONDS", "10"))
+WORKER_READY_TIMEOUT = 10
+WORKER_RESTART_MAX_DELAY = 30
+# A worker that stays up this long is considered healthy again
+WORKER_STABLE_SECONDS = 10
+METRICS_SNAPSHOT_INTERVAL = 1.0
+CONNECTION_BACKLOG = 5
+
+# Sessions live in SQLite so that every worker process sees them
+SESSION_DATABASE_PATH = os.environ.get("WEB_SESSION_DATABASE_PATH", "web_sessions.db")
+SESSION_MAX_AGE = 86400
 
 # Chat server configuration
-CHAT_SERVER_HOST = "hawk.cs.umanitoba.ca"
-CHAT_SERVER_PORT = 8635
-
+CHAT_SERVER_HOST = os.environ.get("CHAT_SERVER_HOST", "hawk.cs.umanitoba.ca")
+CHAT_SERVER_PORT = int(os.environ.get("CHAT_SERVER_PORT", "8635"))
+# Time allowed for a whole chat server command, from connecting to the reply
+CHAT_RPC_DEADLINE = float(os.environ.get("WEB_CHAT_RPC_DEADLINE", "5"))
+# A read not answered this quickly is also sent on a second connection; 0 (the
+# default) turns this off, since both connections reach the same chat server
+CHAT_RPC_HEDGE_DELAY = float(os.environ.get("WEB_CHAT_RPC_HEDGE_DELAY", "0"))
+IDEMPOTENT_COMMANDS = {"GET_MESSAGES", "GET_CHANGES", "SEARCH", "USER_MESSAGES"}
+# Consecutive failures that open the chat server's circuit, and how long it then
+# rejects commands before letting a trial one through
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_OPEN_SECONDS = 5.0
+
+# Serve message polls from a local replica kept current over SUBSCRIBE
+MESSAGE_REPLICA_ENABLED = os.environ.get("WEB_MESSAGE_REPLICA", "1") == "1"
+# Newest messages the replica holds; polls for older ones go to the chat server
+REPLICA_MAX_MESSAGES = int(os.environ.get("WEB_REPLICA_MAX_MESSAGES", "100000"))
+# Newest messages in a change feed reset; shared with the chat server's setting
+CHANGE_RESET_TAIL = int(os.environ.get("CHAT_CHANGE_RESET_TAIL", "1000"))
+# The chat server sends a heartbeat every 15 seconds on an idle subscription
+REPLICA_READ_TIMEOUT = 45
+REPLICA_RECONNECT_BASE_DELAY = 0.5
+REPLICA_RECONNECT_MAX_DELAY = 30
+
+# Page size limit for /api/messages/search, matching the chat server's cap
+SEARCH_MAX_LIMIT = 100
+# Most messages accepted by one batch send or delete
+BATCH_MAX_SIZE = 1000
+# Page size limits for /api/users/<name>/messages, matching the chat server
+USER_MESSAGES_DEFAULT_LIMIT = 50
+USER_MESSAGES_MAX_LIMIT = 100
+# Secret a request must carry in X-Moderator-Token to delete all of a user's
+# messages; logins are not authenticated, so a username alone proves nothing.
+# Unset turns moderation off.
+MODERATOR_TOKEN = os.environ.get("WEB_MODERATOR_TOKEN", "")
+
+# Sessions live in this dict when there is one worker process, and in
+# SESSION_DATABASE_PATH, shared by all workers, when there are several
 user_sessions = {}
+session_database = None
 session_lock = threading.Lock()
 
+# Circuit breaker state of the chat server
+chat_breaker = {"failures": 0, "open_until": 0.0, "trial": False}
+breaker_lock = threading.Lock()
+
+# Set in workers and the supervisor; each process writes its metrics here
+worker_metrics_dir = None
+stop_event = threading.Event()
+
+message_replica = MessageReplica(
+    max_messages=REPLICA_MAX_MESSAGES, reset_tail=CHANGE_RESET_TAIL
+)
+
+HTTP_REQUESTS = metrics.Counter(
+    "webserver_http_requests_total",
+    "HTTP requests handled, by route and status code.",
+    ("route", "method", "status"),
+)
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    "webserver_http_request_seconds",
+    "Time from a fully read HTTP request to the response being sent.",
+    ("route",),
+)
+CHAT_RPC_SECONDS = metrics.Histogram(
+    "webserver_chat_rpc_seconds",
+    "Time spent in each phase of a chat server command.",
+    ("command", "phase"),
+)
+CHAT_RPC_FAILURES = metrics.Counter(
+    "webserver_chat_rpc_failures_total",
+    "Chat server commands that failed to produce a reply.",
+    ("command",),
+)
+CHAT_RPC_HEDGES = metrics.Counter(
+    "webserver_chat_rpc_hedges_total",
+    "Reads sent again on a second connection because the first was slow.",
+    ("command",),
+)
+CHAT_BREAKER_OPEN = metrics.Gauge(
+    "webserver_chat_breaker_open",
+    "1 while the chat server's circuit breaker is open.",
+    callback=lambda: [((), int(breaker_is_open()))],
+)
+WORKER_RESTARTS = metrics.Counter(
+    "webserver_worker_restarts_total",
+    "Worker processes restarted by the supervisor after exiting unexpectedly.",
+)
+REPLICA_RESYNCS = metrics.Counter(
+    "webserver_replica_resyncs_total",
+    "Change subscriptions (re)started by the message replica.",
+)
+REPLICA_READS = metrics.Counter(
+    "webserver_replica_reads_total",
+    "Message polls, by whether the replica or a chat server command answered.",
+    ("source",),
+)
+
 
 def main():
+    if "WEB_SERVER_READY_FD" in os.environ:
+        run_worker()
+        return
+    if WEB_SERVER_WORKERS > 1:
+        supervise_workers()
+        return
+    server_socket = bind_server_socket()
+    print(f"Web server started on port {WEB_SERVER_PORT}")
+    start_message_replica()
+
+    try:
+        serve(server_socket)
+    except KeyboardInterrupt:
+        print("\nShutting down web server. Goodbye.")
+    finally:
+        server_socket.close()
+        sys.exit(0)
+
+
+def bind_server_socket(reuse_port=False, backlog=CONNECTION_BACKLOG):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         server_socket.bind((WEB_SERVER_HOST, WEB_SERVER_PORT))
     except socket.error as e:
         print(f"Failed to bind server on port {WEB_SERVER_PORT}: {e}")
         sys.exit(1)
-    server_socket.listen(5)
-    print(f"Web server started on port {WEB_SERVER_PORT}")
-
-    try:
-        while True:
+    server_socket.listen(backlog)
+    return server_socket
+
+
+def serve(server_socket):
+    """Accept connections until stop_event is set, then drain open requests."""
+    # Non-blocking so workers sharing one listening socket never block in
+    # accept() on a connection another worker already took
+    server_socket.setblocking(False)
+    request_threads = set()
+    while not stop_event.is_set():
+        ready, _, _ = select.select([server_socket], [], [], 0.5)
+        if not ready:
+            continue
+        try:
             client_socket, client_address = server_socket.accept()
-            client_thread = threading.Thread(
-                target=handle_http_client, args=(client_socket,), daemon=True
-            )
-            client_thread.start()
-    except KeyboardInterrupt:
+        except (BlockingIOError, InterruptedError):
+            continue
+        client_thread = threading.Thread(
+            target=handle_http_client,
+            args=(client_socket, client_address),
+            daemon=True,
+        )
+        client_thread.start()
+        request_threads.add(client_thread)
+        if len(request_threads) > 256:
+            request_threads = {t for t in request_threads if t.is_alive()}
+
+    server_socket.close()
+    deadline = time.monotonic() + WORKER_DRAIN_SECONDS
+    for client_thread in request_threads:
+        client_thread.join(max(0, deadline - time.monotonic()))
+
+
+def run_worker():
+    """Entry point of a worker process started by supervise_workers()."""
+    global worker_metrics_dir
+    worker_metrics_dir = os.environ.get("WEB_SERVER_METRICS_DIR")
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if "WEB_SERVER_LISTEN_FD" in os.environ:
+        server_socket = socket.socket(fileno=int(os.environ["WEB_SERVER_LISTEN_FD"]))
+    else:
+        server_socket = bind_server_socket(reuse_port=True, backlog=socket.SOMAXCONN)
+    threading.Thread(target=write_metrics_snapshots, daemon=True).start()
+    start_message_replica()
+    with os.fdopen(int(os.environ["WEB_SERVER_READY_FD"]), "wb") as ready:
+        ready.write(b"1")
+    print(f"Worker {os.getpid()} accepting connections")
+    serve(server_socket)
+    write_metrics_snapshot()
+    print(f"Worker {os.getpid()} stopped")
+
+
+def supervise_workers():
+    """Run WEB_SERVER_WORKERS worker processes and keep them running.
+
+    Workers share the supervisor's listening socket (or bind their own with
+    SO_REUSEPORT), are restarted with backoff when they exit unexpectedly,
+    and are replaced one at a time on SIGHUP so that new code is picked up
+    without refusing connections.
+    """
+    global worker_metrics_dir
+    created_metrics_dir = "WEB_SERVER_METRICS_DIR" not in os.environ
+    if created_metrics_dir:
+        os.environ["WEB_SERVER_METRICS_DIR"] = tempfile.mkdtemp(
+            prefix="webserver-metrics-"
+        )
+    worker_metrics_dir = os.environ["WEB_SERVER_METRICS_DIR"]
+    listen_socket = None
+    if not WEB_SERVER_REUSEPORT:
+        listen_socket = bind_server_socket(backlog=socket.SOMAXCONN)
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    workers = [start_worker(listen_socket) for _ in range(WEB_SERVER_WORKERS)]
+    restart_delays = [1] * WEB_SERVER_WORKERS
+    restart_at = [0] * WEB_SERVER_WORKERS
+    print(
+        f"Web server started on port {WEB_SERVER_PORT} "
+        f"with {WEB_SERVER_WORKERS} workers"
+    )
+    try:
+        while not stop_event.is_set():
+            if reload_requested.is_set():
+                reload_requested.clear()
+                reload_workers(workers, listen_socket)
+            for slot, worker in enumerate(workers):
+                if worker is None:
+                    if time.monotonic() >= restart_at[slot]:
+                        workers[slot] = start_worker(listen_socket)
+                    continue
+                status = worker["process"].poll()
+                if status is None:
+                    continue
+                retire_worker_metrics(worker)
+                WORKER_RESTARTS.inc()
+                write_metrics_snapshot("supervisor")
+                if time.monotonic() - worker["started_at"] > WORKER_STABLE_SECONDS:
+                    restart_delays[slot] = 1
+                print(
+                    f"Worker {worker['process'].pid} exited with status {status}; "
+                    f"restarting in {restart_delays[slot]}s"
+                )
+                workers[slot] = None
+                restart_at[slot] = time.monotonic() + restart_delays[slot]
+                restart_delays[slot] = min(
+                    restart_delays[slot] * 2, WORKER_RESTART_MAX_DELAY
+                )
+            stop_event.wait(0.2)
+    finally:
         print("\nShutting down web server. Goodbye.")
+        stop_workers([worker for worker in workers if worker is not None])
+        if listen_socket is not None:
+            listen_socket.close()
+        if created_metrics_dir:
+            shutil.rmtree(worker_metrics_dir, ignore_errors=True)
+
+
+def start_worker(listen_socket):
+    # Returns None if the worker did not come up; the supervisor retries
+    ready_read, ready_write = os.pipe()
+    env = dict(os.environ, WEB_SERVER_READY_FD=str(ready_write))
+    pass_fds = [ready_write]
+    if listen_socket is not None:
+        env["WEB_SERVER_LISTEN_FD"] = str(listen_socket.fileno())
+        pass_fds.append(listen_socket.fileno())
+    # A fresh interpreter rather than a bare fork, so a reload runs new code
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)], env=env, pass_fds=pass_fds
+    )
+    os.close(ready_write)
+    worker = {"process": process, "started_at": time.monotonic()}
+    try:
+        ready, _, _ = select.select([ready_read], [], [], WORKER_READY_TIMEOUT)
+        if ready and os.read(ready_read, 1) == b"1":
+            return worker
     finally:
-        server_socket.close()
-        sys.exit(0)
+        os.close(ready_read)
+    print(f"Worker {process.pid} did not start")
+    stop_workers([worker])
+    return None
+
+
+def reload_workers(workers, listen_socket):
+    # Replace one worker at a time so the rest keep serving
+    print("Reloading workers")
+    for slot, old_worker in enumerate(workers):
+        new_worker = start_worker(listen_socket)
+        if new_worker is None:
+            print("Reload aborted; the remaining workers keep running")
+            return
+        workers[slot] = new_worker
+        if old_worker is not None:
+            stop_workers([old_worker])
+    print("Reload complete")
+
+
+def stop_workers(workers):
+    for worker in workers:
+        if worker["process"].poll() is None:
+            worker["process"].terminate()
+    for worker in workers:
+        try:
+            worker["process"].wait(WORKER_DRAIN_SECONDS + 5)
+        except subprocess.TimeoutExpired:
+            worker["process"].kill()
+            worker["process"].wait()
+        retire_worker_metrics(worker)
+
+
+def metrics_snapshot_path(name):
+    return os.path.join(worker_metrics_dir, f"{name}.json")
+
+
+def write_metrics_snapshot(name=None):
+    path = metrics_snapshot_path(name or f"worker-{os.getpid()}")
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(metrics.collect_metrics(), f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Error writing metrics snapshot {path}: {e}")
+
+
+def write_metrics_snapshots():
+    while not stop_event.wait(METRICS_SNAPSHOT_INTERVAL):
+        write_metrics_snapshot()
 
 
-def handle_http_client(client_socket):
+def read_metrics_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def retire_worker_metrics(worker):
+    # Fold a stopped worker's last snapshot into the running total so that
+    # counters do not go backwards when workers come and go. Its gauges
+    # describe a process that is gone, so they are dropped.
+    path = metrics_snapshot_path(f"worker-{worker['process'].pid}")
+    if not os.path.exists(path):
+        return
+    retired_path = metrics_snapshot_path("retired")
+    totals = [
+        metric for metric in read_metrics_snapshot(path) if metric["type"] != "gauge"
+    ]
+    merged = metrics.merge_collected([read_metrics_snapshot(retired_path), totals])
+    with open(retired_path + ".tmp", "w") as f:
+        json.dump(merged, f)
+    os.replace(retired_path + ".tmp", retired_path)
+    os.remove(path)
+
+
+def render_all_metrics():
+    # In a worker, add up the snapshots of every other worker, the retired
+    # ones and the supervisor with this process's live values
+    if worker_metrics_dir is None:
+        return metrics.render_metrics()
+    own_snapshot = f"worker-{os.getpid()}.json"
+    collections = [metrics.collect_metrics()]
+    for name in os.listdir(worker_metrics_dir):
+        if name.endswith(".json") and name != own_snapshot:
+            collections.append(
+                read_metrics_snapshot(os.path.join(worker_metrics_dir, name))
+            )
+    return metrics.render_collected(metrics.merge_collected(collections))
+
+
+def handle_http_client(client_socket, client_address):
     try:
         request_data = read_http_request(client_socket)
         if not request_data:
             client_socket.close()
             return
+        request_start = time.perf_counter()
+        tracing.start_trace("webserver", "http", start=request_start)
         try:
-            method, path, version, headers, body = parse_http_request(request_data)
+            with tracing.span("http_parse"):
+                method, path, version, headers, body = parse_http_request(request_data)
         except ValueError as ve:
             response = "HTTP/1.1 400 Bad Request\r\n"
             response += "Content-Type: text/plain\r\n"
@@ -63,16 +427,66 @@ def handle_http_client(client_socket):
             except socket.error as se:
                 print(f"Failed to send response: {se}")
             print(f"Error handling HTTP client: {ve}")
+            record_http_request("invalid", "", response, request_start)
             return
+        # Set after parsing so a client cannot supply its own address header
+        headers["Remote-Addr"] = client_address[0]
+        route = route_label(path)
+        tracing.current_trace().name = f"{method} {route}"
         response = process_http_request(method, path, headers, body)
-        if isinstance(response, bytes):
-            client_socket.sendall(response)
-        else:
-            client_socket.sendall(response.encode("utf-8"))
+        response = add_trace_header(response)
+        with tracing.span("http_send"):
+            if isinstance(response, bytes):
+                client_socket.sendall(response)
+            else:
+                client_socket.sendall(response.encode("utf-8"))
+        record_http_request(route, method, response, request_start)
     except Exception as e:
         print(f"Error handling HTTP client: {e}")
     finally:
         client_socket.close()
+        tracing.finish_trace()
+
+
+def add_trace_header(response):
+    # Echo the trace id so a slow response can be found in the trace file
+    trace_id = tracing.current_trace_id()
+    if isinstance(response, bytes):
+        return response.replace(
+            b"\r\n", f"\r\nX-Trace-Id: {trace_id}\r\n".encode("ascii"), 1
+        )
+    return response.replace("\r\n", f"\r\nX-Trace-Id: {trace_id}\r\n", 1)
+
+
+def route_label(path):
+    # Collapse request paths into a bounded set of label values
+    path = path.split("?", 1)[0]
+    if path in (
+        "/",
+        "/api/login",
+        "/api/messages",
+        "/api/messages/search",
+        "/api/messages/batch",
+        "/api/metrics",
+    ):
+        return path
+    if re.fullmatch(r"/api/messages/\d+", path):
+        return "/api/messages/{id}"
+    if re.fullmatch(r"/api/users/[^/]+/messages", path):
+        return "/api/users/{name}/messages"
+    if path.startswith("/api/"):
+        return "/api/other"
+    return "static"
+
+
+def record_http_request(route, method, response, request_start):
+    # Responses always begin with "HTTP/1.1 NNN"
+    status = response[9:12]
+    if isinstance(status, bytes):
+        status = status.decode("ascii", errors="replace")
+    tracing.current_trace().attributes["status"] = status
+    HTTP_REQUESTS.inc((route, method, status))
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - request_start, (route,))
 
 
 def read_http_request(client_socket):
@@ -214,18 +628,32 @@ def serve_static_file(file_path, headers):
 
 
 def handle_api_request(method, path, headers, body):
-    if path == "/api/login" and method == "POST":
+    if path == "/api/metrics" and method == "GET":
+        return api_metrics(headers)
+    elif path == "/api/login" and method == "POST":
         return api_user_login(headers, body)
     elif path == "/api/login" and method == "DELETE":
         return api_user_logout(headers)
     elif path == "/api/login" and method == "GET":
         return api_check_user_login(headers)
+    elif (
+        path == "/api/messages/search" or path.startswith("/api/messages/search?")
+    ) and method == "GET":
+        return api_search_messages(headers)
+    elif path == "/api/messages/batch" and method == "POST":
+        return api_send_messages(headers, body)
+    elif path == "/api/messages/batch" and method == "DELETE":
+        return api_remove_messages(headers, body)
     elif path.startswith("/api/messages") and method == "GET":
         return api_retrieve_messages(headers)
     elif path == "/api/messages" and method == "POST":
         return api_send_message(headers, body)
     elif path.startswith("/api/messages/") and method == "DELETE":
         return api_remove_message(method, path, headers)
+    elif path.startswith("/api/users/") and method == "GET":
+        return api_user_messages(path, headers)
+    elif path.startswith("/api/users/") and method == "DELETE":
+        return api_remove_user_messages(path, headers)
     else:
         response = "HTTP/1.1 404 Not Found\r\n"
         response += "Content-Type: text/plain\r\n"
@@ -235,6 +663,27 @@ def handle_api_request(method, path, headers, body):
         return response
 
 
+def api_metrics(headers):
+    # Metrics are only exposed to clients on the same machine
+    if headers.get("Remote-Addr") not in ("127.0.0.1", "::1"):
+        response = "HTTP/1.1 403 Forbidden\r\n"
+        response += "Content-Type: text/plain\r\n"
+        response += "Content-Length: 9\r\n"
+        response += "\r\n"
+        response += "Forbidden"
+        return response
+    response_body = render_all_metrics()
+    chat_server_metrics = chat_server_rpc("METRICS", read_until_close=True)
+    if chat_server_metrics:
+        response_body += chat_server_metrics.decode("utf-8")
+    response_body = response_body.encode("utf-8")
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: text/plain; version=0.0.4\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    return response.encode("utf-8") + response_body
+
+
 def parse_cookie_header(cookie_header):
     cookies = {}
     if not cookie_header:
@@ -247,6 +696,80 @@ def parse_cookie_header(cookie_header):
     return cookies
 
 
+def get_session_username(headers):
+    # Returns the logged-in username for the request's session cookie, or None
+    with tracing.span("session"):
+        cookies = parse_cookie_header(headers.get("Cookie", ""))
+        session_id = cookies.get("session_id")
+        if not session_id:
+            return None
+        return lookup_session(session_id)
+
+
+def open_session_database():
+    global session_database
+    if session_database is None:
+        connection = sqlite3.connect(
+            SESSION_DATABASE_PATH, timeout=5, check_same_thread=False
+        )
+        # WAL lets workers read sessions while another one is logging in
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)"
+        )
+        connection.commit()
+        session_database = connection
+    return session_database
+
+
+def lookup_session(session_id):
+    if WEB_SERVER_WORKERS == 1:
+        with session_lock:
+            return user_sessions.get(session_id)
+    with session_lock:
+        cursor = open_session_database().execute(
+            "SELECT username FROM sessions WHERE session_id = ? AND expires_at > ?",
+            (session_id, time.time()),
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def store_session(session_id, username):
+    if WEB_SERVER_WORKERS == 1:
+        with session_lock:
+            user_sessions[session_id] = username
+        return
+    now = time.time()
+    with session_lock:
+        connection = open_session_database()
+        connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+        connection.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, username, expires_at) "
+            "VALUES (?, ?, ?)",
+            (session_id, username, now + SESSION_MAX_AGE),
+        )
+        connection.commit()
+
+
+def delete_session(session_id):
+    if WEB_SERVER_WORKERS == 1:
+        with session_lock:
+            user_sessions.pop(session_id, None)
+        return
+    with session_lock:
+        connection = open_session_database()
+        connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        connection.commit()
+
+
 def api_user_login(headers, body):
     try:
         data = json.loads(body)
@@ -254,11 +777,11 @@ def api_user_login(headers, body):
         if not username:
             raise ValueError("No username provided")
         session_id = str(uuid.uuid4())
-        with session_lock:
-            user_sessions[session_id] = username
+        store_session(session_id, username)
         response = "HTTP/1.1 200 OK\r\n"
         response += (
-            f"Set-Cookie: session_id={session_id}; Path=/; Max-Age=86400; HttpOnly\r\n"
+            f"Set-Cookie: session_id={session_id}; Path=/; "
+            f"Max-Age={SESSION_MAX_AGE}; HttpOnly\r\n"
         )
         response += "Content-Type: application/json\r\n"
         response += "Content-Length: 2\r\n"
@@ -278,9 +801,8 @@ def api_user_login(headers, body):
 def api_user_logout(headers):
     cookies = parse_cookie_header(headers.get("Cookie", ""))
     session_id = cookies.get("session_id")
-    with session_lock:
-        if session_id and session_id in user_sessions:
-            del user_sessions[session_id]
+    if session_id:
+        delete_session(session_id)
     response = "HTTP/1.1 200 OK\r\n"
     response += "Set-Cookie: session_id=; Path=/; Max-Age=0; HttpOnly\r\n"
     response += "Content-Type: application/json\r\n"
@@ -291,50 +813,212 @@ def api_user_logout(headers):
 
 
 def api_check_user_login(headers):
-    cookies = parse_cookie_header(headers.get("Cookie", ""))
-    session_id = cookies.get("session_id")
-    with session_lock:
-        if session_id and session_id in user_sessions:
-            username = user_sessions[session_id]
-            response_body = json.dumps({"username": username})
-            response = "HTTP/1.1 200 OK\r\n"
+    username = get_session_username(headers)
+    if username is not None:
+        response_body = json.dumps({"username": username})
+        response = "HTTP/1.1 200 OK\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+    else:
+        response_body = json.dumps({})
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+    return response
+
+
+def api_retrieve_messages(headers):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+
+    path = headers.get("Path", "")
+    # Optional page size so long histories can be read in pieces
+    match = re.search(r"[?&]limit=(\d+)", path)
+    limit = int(match.group(1)) if match else None
+    if limit is not None and limit <= 0:
+        # Same as the chat server: no limit
+        limit = None
+    match = re.search(r"[?&]since=(\d+)", path)
+    if match:
+        return api_retrieve_changes(int(match.group(1)), limit)
+
+    match = re.search(r"\?last=(\d+)", path)
+    if match:
+        last_id = int(match.group(1))
+    else:
+        last_id = 0
+
+    messages_json = None
+    if message_replica.live:
+        # Already JSON, emitted straight from the replica's columns; None if
+        # last_id is older than the messages the replica holds
+        messages_json = message_replica.messages_since(last_id, limit)
+    if messages_json is not None:
+        REPLICA_READS.inc(("replica",))
+        messages_json = messages_json.decode("ascii")
+    else:
+        REPLICA_READS.inc(("chat_server",))
+        messages = fetch_messages_from_chat_server(last_id, limit)
+        if messages is None:
+            # Chat server is unavailable
+            response_body = json.dumps({"error": "Chat server is unavailable."})
+            response = "HTTP/1.1 503 Service Unavailable\r\n"
             response += "Content-Type: application/json\r\n"
             response += f"Content-Length: {len(response_body)}\r\n"
             response += "\r\n"
             response += response_body
-        else:
-            response_body = json.dumps({})
-            response = "HTTP/1.1 401 Unauthorized\r\n"
+            return response
+        messages_json = json.dumps(messages)
+
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(messages_json)}\r\n"
+    response += "\r\n"
+    response += messages_json
+    return response
+
+
+def api_retrieve_changes(since, limit):
+    response_body = None
+    if message_replica.live:
+        response_body = message_replica.changes_since(since, limit)
+    if response_body is not None:
+        REPLICA_READS.inc(("replica",))
+        response_body = response_body.decode("ascii")
+    else:
+        REPLICA_READS.inc(("chat_server",))
+        changes = fetch_changes_from_chat_server(since, limit)
+        if changes is False:
+            response_body = json.dumps(
+                {"error": "The chat server's storage has no change feed; use ?last=."}
+            )
+            response = "HTTP/1.1 501 Not Implemented\r\n"
             response += "Content-Type: application/json\r\n"
             response += f"Content-Length: {len(response_body)}\r\n"
             response += "\r\n"
             response += response_body
-    return response
-
-
-def api_retrieve_messages(headers):
-    cookies = parse_cookie_header(headers.get("Cookie", ""))
-    session_id = cookies.get("session_id")
-    with session_lock:
-        if not session_id or session_id not in user_sessions:
-            response = "HTTP/1.1 401 Unauthorized\r\n"
+            return response
+        if changes is None:
+            response_body = json.dumps({"error": "Chat server is unavailable."})
+            response = "HTTP/1.1 503 Service Unavailable\r\n"
             response += "Content-Type: application/json\r\n"
-            response += "Content-Length: 2\r\n"
+            response += f"Content-Length: {len(response_body)}\r\n"
             response += "\r\n"
-            response += "{}"
+            response += response_body
             return response
-        username = user_sessions[session_id]
+        response_body = json.dumps(changes)
+
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    response += response_body
+    return response
 
-    path = headers.get("Path", "")
-    match = re.search(r"\?last=(\d+)", path)
-    if match:
-        last_id = int(match.group(1))
-    else:
-        last_id = 0
 
-    messages = fetch_messages_from_chat_server(last_id)
+def api_search_messages(headers):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+
+    query_string = urllib.parse.urlsplit(headers.get("Path", "")).query
+    params = urllib.parse.parse_qs(query_string)
+    query = " ".join(params.get("q", [""])[0].split())
+    try:
+        limit = int(params.get("limit", ["20"])[0])
+        offset = int(params.get("offset", ["0"])[0])
+    except ValueError:
+        query = ""
+    if not query or limit <= 0 or offset < 0:
+        response_body = json.dumps({"error": "A non-empty q parameter is required."})
+        response = "HTTP/1.1 400 Bad Request\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    results = search_messages_on_chat_server(query, limit, offset)
+    if results is None:
+        response_body = json.dumps({"error": "Search is unavailable."})
+        response = "HTTP/1.1 503 Service Unavailable\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    # A full page means there may be more results after it
+    next_offset = offset + len(results) if len(results) == limit else None
+    response_body = json.dumps({"results": results, "next_offset": next_offset})
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    response += response_body
+    return response
+
+
+def parse_user_messages_path(path):
+    # "/api/users/<name>/messages[?...]" -> name, or None
+    match = re.fullmatch(r"/api/users/([^/?]+)/messages(\?.*)?", path)
+    if not match:
+        return None
+    name = urllib.parse.unquote(match.group(1))
+    # Chat server commands are split on whitespace
+    if name.split() != [name]:
+        return None
+    return name
+
+
+def api_user_messages(path, headers):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+
+    name = parse_user_messages_path(path)
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    try:
+        # The cursor is the id of the oldest message on the previous page
+        cursor = int(params.get("cursor", ["0"])[0])
+        limit = int(params.get("limit", [str(USER_MESSAGES_DEFAULT_LIMIT)])[0])
+    except ValueError:
+        name = None
+    if name is None or cursor < 0 or limit <= 0:
+        response_body = json.dumps(
+            {"error": "Expected /api/users/<name>/messages?cursor=<id>&limit=<n>."}
+        )
+        response = "HTTP/1.1 400 Bad Request\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    limit = min(limit, USER_MESSAGES_MAX_LIMIT)
+    messages = fetch_user_messages_from_chat_server(name, cursor, limit)
     if messages is None:
-        # Chat server is unavailable
         response_body = json.dumps({"error": "Chat server is unavailable."})
         response = "HTTP/1.1 503 Service Unavailable\r\n"
         response += "Content-Type: application/json\r\n"
@@ -343,27 +1027,82 @@ def api_retrieve_messages(headers):
         response += response_body
         return response
 
-    messages_json = json.dumps(messages)
+    # A full page means there may be older messages after it
+    next_cursor = messages[-1]["id"] if len(messages) == limit else None
+    response_body = json.dumps({"messages": messages, "next_cursor": next_cursor})
     response = "HTTP/1.1 200 OK\r\n"
     response += "Content-Type: application/json\r\n"
-    response += f"Content-Length: {len(messages_json)}\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
     response += "\r\n"
-    response += messages_json
+    response += response_body
     return response
 
 
+def api_remove_user_messages(path, headers):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+    if not is_moderator_request(headers):
+        response_body = json.dumps({"error": "Only moderators can do this."})
+        response = "HTTP/1.1 403 Forbidden\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    name = parse_user_messages_path(path)
+    if name is None:
+        response_body = json.dumps({"error": "Expected /api/users/<name>/messages."})
+        response = "HTTP/1.1 400 Bad Request\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    deleted_ids = delete_user_messages_on_chat_server(name)
+    if deleted_ids is None:
+        response_body = json.dumps(
+            {"error": "Failed to delete messages on chat server."}
+        )
+        response = "HTTP/1.1 503 Service Unavailable\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+    print(f"Moderator '{username}' deleted {len(deleted_ids)} messages by '{name}'")
+    response_body = json.dumps({"deleted": deleted_ids})
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    response += response_body
+    return response
+
+
+def is_moderator_request(headers):
+    token = headers.get("X-Moderator-Token", "")
+    return bool(MODERATOR_TOKEN) and hmac.compare_digest(
+        token.encode("utf-8"), MODERATOR_TOKEN.encode("utf-8")
+    )
+
+
 def api_send_message(headers, body):
-    cookies = parse_cookie_header(headers.get("Cookie", ""))
-    session_id = cookies.get("session_id")
-    with session_lock:
-        if not session_id or session_id not in user_sessions:
-            response = "HTTP/1.1 401 Unauthorized\r\n"
-            response += "Content-Type: application/json\r\n"
-            response += "Content-Length: 2\r\n"
-            response += "\r\n"
-            response += "{}"
-            return response
-        username = user_sessions[session_id]
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
     try:
         data = json.loads(body)
         message = data.get("message")
@@ -397,6 +1136,99 @@ def api_send_message(headers, body):
         return response
 
 
+def api_send_messages(headers, body):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+    try:
+        messages = json.loads(body).get("messages")
+        if not isinstance(messages, list) or not 0 < len(messages) <= BATCH_MAX_SIZE:
+            raise ValueError("Expected a list of messages")
+        for message in messages:
+            if not isinstance(message, str) or not message or "\n" in message:
+                raise ValueError("Invalid message in batch")
+    except Exception as e:
+        print(f"Error in api_send_messages: {e}")
+        response_body = json.dumps(
+            {"error": f"Send a list of 1 to {BATCH_MAX_SIZE} single-line messages."}
+        )
+        response = "HTTP/1.1 400 Bad Request\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    message_ids = send_messages_to_chat_server(username, messages)
+    if message_ids is None:
+        response_body = json.dumps({"error": "Failed to send messages to chat server."})
+        response = "HTTP/1.1 503 Service Unavailable\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+    response_body = json.dumps({"ids": message_ids})
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    response += response_body
+    return response
+
+
+def api_remove_messages(headers, body):
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
+    try:
+        message_ids = json.loads(body).get("ids")
+        if not isinstance(message_ids, list) or len(message_ids) > BATCH_MAX_SIZE:
+            raise ValueError("Expected a list of ids")
+        message_ids = [int(message_id) for message_id in message_ids]
+    except Exception as e:
+        print(f"Error in api_remove_messages: {e}")
+        response_body = json.dumps(
+            {"error": f"Send a list of at most {BATCH_MAX_SIZE} message ids."}
+        )
+        response = "HTTP/1.1 400 Bad Request\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+
+    deleted_ids = delete_messages_on_chat_server(username, message_ids)
+    if deleted_ids is None:
+        response_body = json.dumps(
+            {"error": "Failed to delete messages on chat server."}
+        )
+        response = "HTTP/1.1 503 Service Unavailable\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += f"Content-Length: {len(response_body)}\r\n"
+        response += "\r\n"
+        response += response_body
+        return response
+    # Ids that were missing or owned by someone else are left out of "deleted"
+    response_body = json.dumps({"deleted": deleted_ids})
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: application/json\r\n"
+    response += f"Content-Length: {len(response_body)}\r\n"
+    response += "\r\n"
+    response += response_body
+    return response
+
+
 def api_remove_message(method, path, headers):
     # Extract message ID from the path
     match = re.match(r"/api/messages/(\d+)", path)
@@ -410,17 +1242,14 @@ def api_remove_message(method, path, headers):
 
     message_id = int(match.group(1))
 
-    cookies = parse_cookie_header(headers.get("Cookie", ""))
-    session_id = cookies.get("session_id")
-    with session_lock:
-        if not session_id or session_id not in user_sessions:
-            response = "HTTP/1.1 401 Unauthorized\r\n"
-            response += "Content-Type: application/json\r\n"
-            response += "Content-Length: 2\r\n"
-            response += "\r\n"
-            response += "{}"
-            return response
-        username = user_sessions[session_id]
+    username = get_session_username(headers)
+    if username is None:
+        response = "HTTP/1.1 401 Unauthorized\r\n"
+        response += "Content-Type: application/json\r\n"
+        response += "Content-Length: 2\r\n"
+        response += "\r\n"
+        response += "{}"
+        return response
 
     # Send delete request to the chat server
     success = delete_message_on_chat_server(username, message_id)
@@ -440,148 +1269,363 @@ def api_remove_message(method, path, headers):
 
 
 def send_message_to_chat_server(username, message):
+    response = chat_server_rpc(f"SEND_MESSAGE {username} {message}")
+    if response:
+        response_decoded = response.decode("utf-8").strip()
+        print(f"Received acknowledgment from chat server: '{response_decoded}'")
+        if response_decoded == "SUCCESS":
+            return True
+        print("Failed to send message as per chat server response.")
+        return False
+    print("No response from chat server after sending message.")
+    return False
+
+
+def delete_message_on_chat_server(username, message_id):
+    response = chat_server_rpc(f"DELETE_MESSAGE {message_id} {username}")
+    if response:
+        response_decoded = response.decode("utf-8").strip()
+        print(f"Received acknowledgment from chat server: '{response_decoded}'")
+        if response_decoded == "SUCCESS":
+            return True
+        print("Failed to delete message as per chat server response.")
+        return False
+    print("No response from chat server after sending delete command.")
+    return False
+
+
+def send_messages_to_chat_server(username, messages):
+    frame = json.dumps(
+        [{"username": username, "message": message} for message in messages]
+    ).encode("utf-8")
+    return batch_rpc("SEND_MESSAGES", frame)
+
+
+def delete_messages_on_chat_server(username, message_ids):
+    frame = json.dumps({"username": username, "ids": message_ids}).encode("utf-8")
+    return batch_rpc("DELETE_MESSAGES", frame)
+
+
+def batch_rpc(command_name, frame):
+    # The chat server replies with a JSON list of ids, or INVALID_COMMAND
+    reply = chat_server_rpc(
+        f"{command_name} {len(frame)}", read_until_close=True, payload=frame
+    )
+    if not reply:
+        print(f"No response from chat server for {command_name}.")
+        return None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        print(
-            f"Attempting to connect to chat server at {CHAT_SERVER_HOST}:{CHAT_SERVER_PORT}"
-        )
-        sock.connect((CHAT_SERVER_HOST, CHAT_SERVER_PORT))
-        print("Connected to chat server successfully.")
+        return json.loads(reply.decode("utf-8"))
+    except ValueError:
+        print(f"Chat server rejected {command_name}: {reply.decode('utf-8').strip()}")
+        return None
 
-        # Wait for the prompt from the chat server
-        data = receive_from_chat_server(sock, b"Enter your username:", timeout=2)
-        if data is None:
-            print("Did not receive username prompt from chat server.")
-            return False
 
-        # Send special username to identify as web client
-        sock.sendall("__WebClient__\n".encode("utf-8"))
-        print("Sent identifier '__WebClient__' to chat server.")
-
-        # Send command to send message
-        command = f"SEND_MESSAGE {username} {message}\n"
-        sock.sendall(command.encode("utf-8"))
-        print(f"Sent command to chat server: {command.strip()}")
-
-        # Wait for acknowledgment
-        response = receive_from_chat_server(sock, b"", timeout=2)
-        if response:
-            response_decoded = response.decode("utf-8").strip()
-            print(f"Received acknowledgment from chat server: '{response_decoded}'")
-            if response_decoded == "SUCCESS":
-                return True
-            else:
-                print("Failed to send message as per chat server response.")
-                return False
-        else:
-            print("No response from chat server after sending message.")
-            return False
+def fetch_messages_from_chat_server(last_id, limit=None):
+    command = f"GET_MESSAGES {last_id}"
+    if limit:
+        command += f" {limit}"
+    json_data = chat_server_rpc(command, read_until_close=True)
+    if not json_data:
+        # The chat server always answers with a JSON list, even an empty one
+        print("No messages received from chat server.")
+        return None
+    print("Received messages from chat server.")
+    try:
+        return json.loads(json_data.decode("utf-8"))
+    except ValueError as e:
+        print(f"Error decoding messages from chat server: {e}")
+        return None
 
-    except Exception as e:
-        print(f"Error connecting to chat server: {e}")
+
+def fetch_changes_from_chat_server(since, limit=None):
+    # Returns None if the chat server is unreachable and False if its
+    # storage backend has no change feed
+    command = f"GET_CHANGES {since}"
+    if limit:
+        command += f" {limit}"
+    json_data = chat_server_rpc(command, read_until_close=True)
+    if not json_data:
+        return None
+    if json_data.strip() == b"UNSUPPORTED":
         return False
-    finally:
-        sock.close()
-        print("Closed connection to chat server.")
+    try:
+        return json.loads(json_data.decode("utf-8"))
+    except ValueError as e:
+        print(f"Error decoding changes from chat server: {e}")
+        return None
 
 
-def delete_message_on_chat_server(username, message_id):
+def start_message_replica():
+    if MESSAGE_REPLICA_ENABLED:
+        threading.Thread(target=follow_chat_server_changes, daemon=True).start()
+
+
+def follow_chat_server_changes():
+    """Keep message_replica current, resubscribing whenever the stream breaks."""
+    delay = REPLICA_RECONNECT_BASE_DELAY
+    while not stop_event.is_set():
+        result = subscribe_to_chat_server()
+        message_replica.live = False
+        if result is False:
+            print("Chat server storage has no change feed; replica disabled.")
+            return
+        if result:
+            delay = REPLICA_RECONNECT_BASE_DELAY
+        wait = random.uniform(0, delay)
+        print(f"Replica subscription lost; resubscribing in {wait:.1f}s")
+        stop_event.wait(wait)
+        delay = min(delay * 2, REPLICA_RECONNECT_MAX_DELAY)
+
+
+def subscribe_to_chat_server():
+    # Returns False if the chat server has no change feed, True once a
+    # snapshot was loaded and None if the stream broke before that
+    sock = None
+    loaded = None
     try:
+        deadline = time.monotonic() + CHAT_RPC_DEADLINE
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        print(
-            f"Attempting to connect to chat server at {CHAT_SERVER_HOST}:{CHAT_SERVER_PORT}"
-        )
+        sock.settimeout(CHAT_RPC_DEADLINE)
         sock.connect((CHAT_SERVER_HOST, CHAT_SERVER_PORT))
-        print("Connected to chat server successfully.")
-
-        # Wait for the prompt from the chat server
-        data = receive_from_chat_server(sock, b"Enter your username:", timeout=2)
-        if data is None:
-            print("Did not receive username prompt from chat server.")
+        if receive_from_chat_server(sock, b"Enter your username:", deadline) is None:
+            return loaded
+        sock.settimeout(REPLICA_READ_TIMEOUT)
+        # Resume from the replica's seq; a cursor the chat server can no
+        # longer serve comes back as a reset of only the newest messages
+        command = f"SUBSCRIBE {message_replica.seq} {REPLICA_MAX_MESSAGES}"
+        sock.sendall(f"__WebClient__\n{command}\n".encode())
+        stream = sock.makefile("rb")
+        line = stream.readline()
+        if line.strip() == b"UNSUPPORTED":
             return False
+        if not line.endswith(b"\n"):
+            return loaded
+        message_replica.load(json.loads(line))
+        REPLICA_RESYNCS.inc()
+        loaded = True
+        message_replica.live = True
+        print(f"Replica subscribed at change seq {message_replica.seq}")
+        for line in stream:
+            if not line.endswith(b"\n"):
+                break
+            if line.strip():
+                message_replica.apply(json.loads(line))
+        return loaded
+    except (OSError, ValueError) as e:
+        print(f"Replica subscription error: {e}")
+        return loaded
+    finally:
+        if sock is not None:
+            sock.close()
 
-        # Send special username to identify as web client
-        sock.sendall("__WebClient__\n".encode("utf-8"))
-        print("Sent identifier '__WebClient__' to chat server.")
-
-        # Send delete command
-        command = f"DELETE_MESSAGE {message_id} {username}\n"
-        sock.sendall(command.encode("utf-8"))
-        print(f"Sent command to chat server: {command.strip()}")
-
-        # Receive response from chat server
-        response = receive_from_chat_server(sock, b"", timeout=2)
-        if response:
-            response_decoded = response.decode("utf-8").strip()
-            print(f"Received acknowledgment from chat server: '{response_decoded}'")
-            if response_decoded == "SUCCESS":
-                return True
-            else:
-                print("Failed to delete message as per chat server response.")
-                return False
+
+def fetch_user_messages_from_chat_server(username, before, limit):
+    json_data = chat_server_rpc(
+        f"USER_MESSAGES {username} {before} {limit}", read_until_close=True
+    )
+    if not json_data:
+        return None
+    try:
+        return json.loads(json_data.decode("utf-8"))
+    except ValueError:
+        print(f"Chat server rejected USER_MESSAGES: {json_data.decode('utf-8')}")
+        return None
+
+
+def delete_user_messages_on_chat_server(username):
+    json_data = chat_server_rpc(
+        f"DELETE_USER_MESSAGES {username}", read_until_close=True
+    )
+    if not json_data:
+        return None
+    try:
+        return json.loads(json_data.decode("utf-8"))
+    except ValueError:
+        print(f"Chat server rejected DELETE_USER_MESSAGES: {json_data.decode('utf-8')}")
+        return None
+
+
+def search_messages_on_chat_server(query, limit, offset):
+    json_data = chat_server_rpc(
+        f"SEARCH {limit} {offset} {query}", read_until_close=True
+    )
+    if not json_data:
+        return None
+    try:
+        results = json.loads(json_data.decode("utf-8"))
+    except ValueError:
+        print(f"Chat server rejected search: {json_data.decode('utf-8').strip()}")
+        return None
+    print(f"Received {len(results)} search results from chat server.")
+    return results
+
+
+def chat_server_rpc(command, read_until_close=False, payload=None):
+    """Run one command against the chat server and return its raw reply.
+
+    payload, if given, is sent as raw bytes straight after the command line.
+
+    The whole exchange shares one deadline, CHAT_RPC_DEADLINE. While the
+    circuit breaker is open, commands fail at once instead of after a connect
+    timeout. Each call counts once towards the breaker. If CHAT_RPC_HEDGE_DELAY
+    is set, IDEMPOTENT_COMMANDS are hedged: if the chat server has not
+    answered within that delay, the command is sent again on a second
+    connection and the first reply wins. Other commands are sent once.
+
+    Each phase (connect, username prompt, command, reply) is timed into
+    CHAT_RPC_SECONDS. Returns None if the chat server did not reply in time.
+    """
+    command_name = command.split(" ", 1)[0]
+    deadline = time.monotonic() + CHAT_RPC_DEADLINE
+    if not breaker_allows():
+        reply = None
+    else:
+        if CHAT_RPC_HEDGE_DELAY > 0 and command_name in IDEMPOTENT_COMMANDS:
+            reply = hedged_chat_rpc(command, read_until_close, deadline)
         else:
-            print("No response from chat server after sending delete command.")
-            return False
-    except Exception as e:
-        print(f"Error deleting message from chat server: {e}")
-        return False
-    finally:
-        sock.close()
-        print("Closed connection to chat server.")
+            reply = run_chat_command(command, read_until_close, payload, deadline)
+        record_chat_result(reply is not None)
+    if reply is None:
+        CHAT_RPC_FAILURES.inc((command_name,))
+    return reply
+
+
+def hedged_chat_rpc(command, read_until_close, deadline):
+    command_name = command.split(" ", 1)[0]
+    trace = tracing.current_trace()
+    replies = queue.SimpleQueue()
+    threading.Thread(
+        target=run_hedged_attempt,
+        args=(replies, trace, command, read_until_close, deadline),
+        daemon=True,
+    ).start()
+    in_flight = 1
+    hedge_at = time.monotonic() + CHAT_RPC_HEDGE_DELAY
+    while in_flight:
+        try:
+            wait = min(hedge_at, deadline) - time.monotonic()
+            reply = replies.get(timeout=max(0, wait))
+        except queue.Empty:
+            if time.monotonic() >= deadline:
+                return None
+            # Only hedge once
+            hedge_at = deadline
+            CHAT_RPC_HEDGES.inc((command_name,))
+            threading.Thread(
+                target=run_hedged_attempt,
+                args=(replies, trace, command, read_until_close, deadline),
+                daemon=True,
+            ).start()
+            in_flight += 1
+            continue
+        in_flight -= 1
+        if reply is not None:
+            return reply
+    return None
 
 
-def fetch_messages_from_chat_server(last_id):
+def run_hedged_attempt(replies, trace, command, read_until_close, deadline):
+    tracing.attach_trace(trace)
+    replies.put(run_chat_command(command, read_until_close, None, deadline))
+
+
+def run_chat_command(command, read_until_close, payload, deadline):
+    """Send command on a new connection; returns the reply or None."""
+    command_name = command.split(" ", 1)[0]
+    sock = None
+    reply = None
     try:
+        phase_start = time.perf_counter()
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
+        sock.settimeout(max(deadline - time.monotonic(), 0.001))
         print(
             f"Attempting to connect to chat server at {CHAT_SERVER_HOST}:{CHAT_SERVER_PORT}"
         )
         sock.connect((CHAT_SERVER_HOST, CHAT_SERVER_PORT))
+        phase_start = observe_rpc_phase(command_name, "connect", phase_start)
         print("Connected to chat server successfully.")
 
         # Wait for the prompt from the chat server
-        data = receive_from_chat_server(sock, b"Enter your username:", timeout=2)
+        data = receive_from_chat_server(sock, b"Enter your username:", deadline)
+        phase_start = observe_rpc_phase(command_name, "prompt", phase_start)
         if data is None:
             print("Did not receive username prompt from chat server.")
             return None
 
-        # Send special username to identify as web client
-        sock.sendall("__WebClient__\n".encode("utf-8"))
-        print("Sent identifier '__WebClient__' to chat server.")
-
-        # Send command to get messages after last_id
-        command = f"GET_MESSAGES {last_id}\n"
-        sock.sendall(command.encode("utf-8"))
-        print(f"Sent command to chat server: {command.strip()}")
-
-        # Receive messages from chat server
-        json_data = receive_all_from_chat_server(sock, timeout=2)
-        if json_data:
-            print("Received messages from chat server.")
-            messages = json.loads(json_data.decode("utf-8"))
-            return messages
+        # Identify as a web client, pass the trace id along, then send the command
+        trace_id = tracing.current_trace_id()
+        trace_line = f"TRACE {trace_id}\n" if trace_id else ""
+        request = f"__WebClient__\n{trace_line}{command}\n".encode("utf-8")
+        sock.settimeout(max(deadline - time.monotonic(), 0.001))
+        sock.sendall(request + payload if payload else request)
+        phase_start = observe_rpc_phase(command_name, "command", phase_start)
+        print(f"Sent command to chat server: {command}")
+
+        if read_until_close:
+            reply = receive_all_from_chat_server(sock, deadline)
         else:
-            print("No messages received from chat server.")
-            return []
+            reply = receive_from_chat_server(sock, b"", deadline)
+        observe_rpc_phase(command_name, "reply", phase_start)
+        return reply
     except Exception as e:
-        print(f"Error fetching messages from chat server: {e}")
+        print(f"Error communicating with chat server: {e}")
         return None
     finally:
-        sock.close()
-        print("Closed connection to chat server.")
+        if sock is not None:
+            sock.close()
+            print("Closed connection to chat server.")
+
+
+def breaker_allows():
+    """Whether a command may go to the chat server now.
+
+    An open circuit lets one trial command through once BREAKER_OPEN_SECONDS
+    have passed; its result closes the circuit or keeps it open.
+    """
+    with breaker_lock:
+        if chat_breaker["failures"] < BREAKER_FAILURE_THRESHOLD:
+            return True
+        if chat_breaker["trial"] or time.monotonic() < chat_breaker["open_until"]:
+            return False
+        chat_breaker["trial"] = True
+        return True
+
+
+def record_chat_result(succeeded):
+    with breaker_lock:
+        chat_breaker["trial"] = False
+        if succeeded:
+            chat_breaker["failures"] = 0
+            return
+        chat_breaker["failures"] += 1
+        if chat_breaker["failures"] >= BREAKER_FAILURE_THRESHOLD:
+            if chat_breaker["failures"] == BREAKER_FAILURE_THRESHOLD:
+                print("Chat server is failing; circuit open")
+            chat_breaker["open_until"] = time.monotonic() + BREAKER_OPEN_SECONDS
 
 
-def receive_from_chat_server(sock, delimiter, timeout):
+def breaker_is_open():
+    with breaker_lock:
+        return chat_breaker["failures"] >= BREAKER_FAILURE_THRESHOLD
+
+
+def observe_rpc_phase(command_name, phase, phase_start):
+    now = time.perf_counter()
+    CHAT_RPC_SECONDS.observe(now - phase_start, (command_name, phase))
+    tracing.add_span(f"chat_{phase}", phase_start, now)
+    return now
+
+
+def receive_from_chat_server(sock, delimiter, deadline):
+    """Read until delimiter arrives; None on EOF, error or the deadline passing."""
     sock.setblocking(0)
     data = b""
-    start_time = time.time()
     while True:
-        if time.time() - start_time > timeout:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
             return None
-        ready = select.select([sock], [], [], timeout)
+        ready = select.select([sock], [], [], remaining)
         if ready[0]:
             try:
                 chunk = sock.recv(4096)
@@ -593,30 +1637,31 @@ def receive_from_chat_server(sock, delimiter, timeout):
             except socket.error as e:
                 print(f"Socket error while receiving data: {e}")
                 return None
-        else:
-            continue
 
 
-def receive_all_from_chat_server(sock, timeout):
+def receive_all_from_chat_server(sock, deadline):
+    """Read until the chat server closes the connection.
+
+    Returns None on an error or if the deadline passes first, since a reply
+    cut short is not a reply.
+    """
     sock.setblocking(0)
     data = b""
-    start_time = time.time()
     while True:
-        if time.time() - start_time > timeout:
-            break
-        ready = select.select([sock], [], [], timeout)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print("Chat server did not finish its reply in time.")
+            return None
+        ready = select.select([sock], [], [], remaining)
         if ready[0]:
             try:
                 chunk = sock.recv(4096)
                 if not chunk:
-                    break
+                    return data
                 data += chunk
             except socket.error as e:
                 print(f"Socket error while receiving data: {e}")
-                break
-        else:
-            continue
-    return data
+                return None
 
 
 if __name__ == "__main__":